@@ -0,0 +1,1401 @@
+# -*- coding: utf-8 -*-
+"""Shared data loading for the FBI crime data dashboard.
+
+Streamlit re-runs fbicrimedata.py from the top every time a widget changes,
+so anything that is expensive to build (downloading and parsing the year
+CSV files, for example) lives here instead. This module is imported once per
+process, which means the cache below is shared by every browser session
+connected to the same server.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# The crime and law enforcement files are read from a pinned commit of the
+# Hackathon2020 repository, so a given (dataset, year, commit) never changes
+# and is safe to keep around for as long as we like. (The law enforcement
+# files are the exception; see LAW_ENFORCEMENT_COMMIT.)
+#
+# FBI_CRIME_DATA_URL can point somewhere else instead (another URL, or a local
+# directory holding <year>_Crime.csv files and so on), for testing or offline
+# use. Those files are cached under a name made from a hash of that location,
+# so different directories never share cache entries, unless
+# FBI_CRIME_DATA_COMMIT gives a name. For a local directory the hash also
+# covers the size and modification time of its CSV files, so files edited in
+# place get new cache entries the next time the process starts. Files changed
+# in place behind a URL need a new FBI_CRIME_DATA_COMMIT (or an emptied cache
+# directory).
+DATA_URL = os.environ.get('FBI_CRIME_DATA_URL',
+                          'https://raw.githubusercontent.com/nixwebb/Hackathon2020/{commit}/Data/')
+
+
+def local_commit(url):
+    """Cache name for data read from url: 'local-' and a hash of the resolved location.
+
+    For a local directory the name, size and modification time of each CSV
+    file in it are hashed as well.
+    """
+    parts = [url]
+    if '://' not in url:
+        url = parts[0] = os.path.abspath(os.path.expanduser(url))
+        if os.path.isdir(url):
+            for name in sorted(os.listdir(url)):
+                if name.endswith('.csv'):
+                    info = os.stat(os.path.join(url, name))
+                    parts.append('%s:%d:%d' % (name, info.st_size, info.st_mtime_ns))
+    return 'local-' + hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:12]
+
+
+DATA_COMMIT = os.environ.get('FBI_CRIME_DATA_COMMIT',
+                             local_commit(DATA_URL) if 'FBI_CRIME_DATA_URL' in os.environ
+                             else 'e464544c903484a9f701f753f90a3604bfa24f82')
+
+# The law enforcement files have always been read from master (they may not
+# exist at DATA_COMMIT), so by default they keep that source. Unlike a pinned
+# commit, master can change, so anything read from a branch is only kept in
+# memory, never in the disk cache (see persistent()). FBI_CRIME_LEE_COMMIT
+# pins it once a commit with the files is known.
+LAW_ENFORCEMENT_COMMIT = os.environ.get('FBI_CRIME_LEE_COMMIT',
+                                        DATA_COMMIT if 'FBI_CRIME_DATA_URL' in os.environ else 'master')
+
+# The state name / abbreviation / FIPS lookup ships with the package and is
+# read once at import, so no session waits on a download for it.
+# FBI_CRIME_STATES_URL can point at another file with the same columns.
+STATES_URL = os.environ.get('FBI_CRIME_STATES_URL',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'states.csv'))
+
+YEARS = ('2014', '2015', '2016', '2017', '2018')
+
+CRIME = 'Crime'
+LAW_ENFORCEMENT = 'LawEnforcement'
+
+# Columns of the year files, as read from the CSVs
+CRIME_COLUMNS = ['state', 'university/college', 'campus', 'student_enrollment',
+                 'violent_crime', 'murder_and_nonnegligent_manslaughter', 'robbery', 'aggravated_assault',
+                 'property_crime', 'burglary', 'larceny_theft', 'motor_vehicle_theft', 'arson']
+LEE_COLUMNS = ['state', 'university/college', 'campus', 'student_enrollment',
+               'total_law_enforcement__employees', 'total_officers', 'total_civilians']
+
+CACHE_DIR = os.environ.get('FBI_CRIME_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'fbicrimedata'))
+CACHE_MAX_BYTES = int(os.environ.get('FBI_CRIME_CACHE_BYTES', 256 * 1024 * 1024))
+
+
+def frame_nbytes(obj):
+    """Approximate in-memory size of a cached value, in bytes."""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum()) if isinstance(obj, pd.DataFrame) else int(usage)
+    if hasattr(obj, 'nbytes'):
+        return int(obj.nbytes)
+    # Stage outputs are often tuples or dicts of frames and arrays
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(frame_nbytes(item) for item in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(frame_nbytes(k) + frame_nbytes(v) for k, v in obj.items())
+    return sys.getsizeof(obj)
+
+
+class FrameCache:
+    """A thread-safe LRU cache of data frames, bounded by total bytes.
+
+    Values are keyed by a tuple such as (dataset, year, commit). When a disk
+    directory is given every loaded value is also pickled there, so a cold
+    process can be served from disk without touching the network. Values that
+    are only inputs to something else are read with fetch(), which uses the
+    disk copy but never holds them in memory. Counters for hits, misses, disk
+    hits and evictions are kept in ``stats``.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.nbytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'disk_hits': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _disk_path(self, key):
+        name = '_'.join(str(part) for part in key).replace('/', '-')
+        return os.path.join(self.cache_dir, name + '.pkl')
+
+    def _read_disk(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _write_disk(self, key, value):
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a temporary file first so a crash never leaves a
+            # half-written pickle behind for the next process to trip over
+            tmp = path + '.%d.tmp' % os.getpid()
+            with open(tmp, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def _store(self, key, value):
+        size = frame_nbytes(value)
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self.nbytes += size
+        # Evict least recently used entries, but always keep the newest one
+        # even if it is bigger than the budget on its own
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self.nbytes -= old_size
+            self.stats['evictions'] += 1
+
+    def get(self, key, loader, persist=True):
+        """Return the value for key, calling loader() to build it on a miss."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self._entries[key][0]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        # Only one thread builds a given key; other keys load concurrently
+        with key_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return self._entries[key][0]
+                self.stats['misses'] += 1
+            value = self._load(key, loader, persist)
+            with self._lock:
+                self._store(key, value)
+                self._loading.pop(key, None)
+            return value
+
+    def fetch(self, key, loader, persist=True):
+        """Return the value for key from the disk copy, or loader(), without keeping it in memory."""
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+            self.stats['misses'] += 1
+        with key_lock:
+            try:
+                return self._load(key, loader, persist)
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+
+    def _load(self, key, loader, persist):
+        value = self._read_disk(key) if persist else None
+        if value is not None:
+            with self._lock:
+                self.stats['disk_hits'] += 1
+            return value
+        value = loader()
+        if persist:
+            self._write_disk(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# One cache for the whole process
+CACHE = FrameCache(CACHE_MAX_BYTES, CACHE_DIR)
+
+
+def source_commit(dataset, commit=DATA_COMMIT):
+    """The commit a dataset's files are actually read from, for a data version."""
+    if dataset == LAW_ENFORCEMENT and commit == DATA_COMMIT:
+        return LAW_ENFORCEMENT_COMMIT
+    return commit
+
+
+def data_url(dataset, year, commit=DATA_COMMIT):
+    """Location of the CSV file for a dataset ('Crime' or 'LawEnforcement') and year."""
+    base = DATA_URL.format(commit=source_commit(dataset, commit))
+    if not base.endswith('/'):
+        base += '/'
+    return base + year + '_' + dataset + '.csv'
+
+
+# Everything built from the year files (the year stores, cube, sketches and so
+# on) is cached under a key that includes this version and the YEARS they
+# cover. Bump it whenever the code that builds them changes what they hold, so
+# pickles written by older code are never read back from the disk cache.
+#   2: year stores are cleaned by clean_frame() and carry a quality report
+DERIVED_VERSION = 2
+
+
+def derived_key(kind, dataset, commit):
+    """The cache key for a value derived from a dataset's year files."""
+    return (kind, dataset, commit, 'v%d' % DERIVED_VERSION, '-'.join(YEARS))
+
+
+def persistent(commit):
+    """Whether the files for commit can never change, so may be kept in the disk cache.
+
+    Commit hashes, local data (see local_commit()) and names given with
+    FBI_CRIME_DATA_COMMIT count as fixed; a branch name such as 'master' does not.
+    """
+    return (re.match(r'[0-9a-f]{7,40}$', commit) is not None or commit.startswith('local-')
+            or commit == os.environ.get('FBI_CRIME_DATA_COMMIT'))
+
+
+def load_year(dataset, year, commit=DATA_COMMIT):
+    """Load one year file of crime or law enforcement data, as read from the CSV.
+
+    The raw file is only kept in the disk cache, not in memory: the dashboard
+    works from the compact store built by load_all_years(), and holding the
+    object-dtype frames as well would more than double the memory used.
+    """
+    source = source_commit(dataset, commit)
+    return CACHE.fetch((dataset, year, source), lambda: pd.read_csv(data_url(dataset, year, commit)),
+                       persist=persistent(source))
+
+
+def normalize_state_names(names):
+    """Upper case state names, without footnote digits, commas or extra spaces (e.g. 'New  York3' -> 'NEW YORK')."""
+    return (names.astype(str).str.upper()
+            .str.replace(r'[0-9,]+', ' ', regex=True)
+            .str.split().str.join(' ')
+            .where(names.notna()))
+
+
+def read_states(path=STATES_URL):
+    """Read a state lookup file, with upper case state names, sorted by name."""
+    states = pd.read_csv(path, dtype=str)
+    states['State'] = normalize_state_names(states['State'])
+    return states.dropna(subset=['State']).drop_duplicates('State').sort_values('State').reset_index(drop=True)
+
+
+STATE_TABLE = read_states()
+
+
+def load_states():
+    """The state name / abbreviation (/ FIPS) lookup, read at import."""
+    return STATE_TABLE
+
+
+def state_abbreviations(names, states=None):
+    """The 'abv' column for a column of state names, as a categorical.
+
+    The lookup is done once per distinct name (the categories of names), so
+    the rows themselves only cost one gather of the category codes. Names
+    that aren't in the lookup get no abbreviation.
+    """
+    states = STATE_TABLE if states is None else states
+    names = names if isinstance(names.dtype, pd.CategoricalDtype) else names.astype('category')
+    lookup = states.set_index('State')['Abbreviation']
+    per_name = pd.Categorical(names.cat.categories.map(lookup), categories=lookup.dropna().unique())
+    # Missing names have code -1, which take() turns into a missing abbreviation
+    abv = per_name.take(names.cat.codes.to_numpy(), allow_fill=True)
+    return pd.Series(abv, index=names.index, name='abv')
+
+
+def prefetch(commit=DATA_COMMIT):
+    """Build both year stores concurrently, then the cube and the other indexes.
+
+    Each store fetches its year files in a thread pool (see
+    load_all_years()), so all the downloads overlap instead of running one
+    after another. Everything ends up in the shared cache, so later loads
+    (from any session) are memory lookups.
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(load_all_years, dataset, commit) for dataset in (CRIME, LAW_ENFORCEMENT)]
+        for future in futures:
+            future.result()
+    load_state_cube(commit)
+    load_sketches(commit)
+    load_rankings(commit)
+    load_trends('state', commit)
+    load_trends('campus', commit)
+
+
+_prefetch_lock = threading.Lock()
+_prefetch_thread = None
+
+
+def start_prefetch():
+    """Run prefetch() in a background thread, once per process; returns the thread.
+
+    A session that asks for data while it is still loading waits for that
+    store to be built rather than starting another build.
+    """
+    global _prefetch_thread
+    with _prefetch_lock:
+        if _prefetch_thread is None:
+            def run():
+                try:
+                    prefetch()
+                except Exception:
+                    # Sessions will load (and report any errors) on demand instead
+                    logging.getLogger(__name__).exception('Prefetching the crime data failed')
+            _prefetch_thread = threading.Thread(target=run, name='crimedata-prefetch', daemon=True)
+            _prefetch_thread.start()
+        return _prefetch_thread
+
+
+class YearStore:
+    """Every year of one dataset held in a single frame.
+
+    Rows are sorted by year and then state, and ``offsets`` records where
+    each year starts and stops, so picking a year is a positional slice of
+    data that is already in memory rather than a new download and parse.
+    """
+
+    def __init__(self, frame, memory=None, quality=None):
+        self.frame = frame
+        self.memory = memory or {}
+        self.quality = quality or {}
+        years = frame['year'].astype(str).to_numpy()
+        starts = np.flatnonzero(np.r_[True, years[1:] != years[:-1]]) if len(years) else np.array([], dtype=int)
+        stops = np.r_[starts[1:], len(years)]
+        self.offsets = {years[start]: (int(start), int(stop)) for start, stop in zip(starts, stops)}
+
+    @property
+    def nbytes(self):
+        return frame_nbytes(self.frame)
+
+    @property
+    def years(self):
+        return list(self.offsets)
+
+    def year(self, year, drop_year=False):
+        """Rows for a single year, as a slice of the combined frame.
+
+        With drop_year the 'year' column, which build_year_store() puts last,
+        is sliced off as well, so the result still shares the store's data.
+        """
+        start, stop = self.offsets.get(year, (0, 0))
+        return self.frame.iloc[start:stop, :-1] if drop_year else self.frame.iloc[start:stop]
+
+
+# Names are repeated on every row, so they are stored as categoricals
+CATEGORY_COLUMNS = ['state', 'university/college', 'campus']
+
+INT32 = np.iinfo(np.int32)
+
+
+def apply_schema(frame):
+    """Store the name columns as categoricals and the counts as 32 bit numbers, in place.
+
+    Integer columns that fit are stored as int32; float columns (counts with
+    missing values, mostly) as float32.
+    """
+    for column in frame.columns:
+        values = frame[column]
+        if column in CATEGORY_COLUMNS:
+            frame[column] = values.astype('category')
+        elif pd.api.types.is_bool_dtype(values) or not pd.api.types.is_numeric_dtype(values):
+            continue
+        elif pd.api.types.is_integer_dtype(values):
+            if len(values) == 0 or (values.min() >= INT32.min and values.max() <= INT32.max):
+                frame[column] = values.astype(np.int32)
+        elif pd.api.types.is_float_dtype(values):
+            frame[column] = values.astype(np.float32)
+    return frame
+
+
+def clean_frame(df, states=None, enrollment='student_enrollment'):
+    """Clean one year's frame in a single vectorized pass; returns (clean frame, quality report).
+
+    - every column other than the names is made numeric ('1,234' -> 1234);
+      anything that still isn't a number becomes missing
+    - zero, negative or missing enrollment becomes missing, so per-1000
+      rates come out as NaN rather than inf
+    - state names are normalized, and checked against the states lookup
+
+    The report counts what was changed, and lists state names that have no
+    abbreviation in the lookup (those rows get no 'abv' and no map colour).
+    """
+    df = df.copy()
+    report = {'rows': len(df)}
+    coerced = {}
+    for column in df.columns:
+        values = df[column]
+        if column in CATEGORY_COLUMNS or pd.api.types.is_numeric_dtype(values):
+            continue
+        numbers = pd.to_numeric(values.astype(str).str.replace(',', '').str.strip(), errors='coerce')
+        coerced[column] = int((numbers.isna() & values.notna()).sum())
+        df[column] = numbers
+    report['coerced_to_missing'] = {column: n for column, n in coerced.items() if n}
+    if enrollment in df:
+        bad = ~(df[enrollment] > 0)
+        report['missing_or_zero_enrollment'] = int(bad.sum())
+        df[enrollment] = df[enrollment].where(~bad)
+    if 'state' in df:
+        names = normalize_state_names(df['state'])
+        report['states_renamed'] = int((names.fillna('') != df['state'].astype(str).where(df['state'].notna(), '')).sum())
+        df['state'] = names
+        if states is not None:
+            unmatched = ~names.isin(states['State'])
+            report['unmatched_rows'] = int(unmatched.sum())
+            report['unmatched_states'] = sorted(names[unmatched].dropna().unique().tolist())
+    return df, report
+
+
+def build_year_store(frames, states=None):
+    """Clean and combine a {year: frame} mapping into a YearStore with a 'year' column.
+
+    The quality report from clean_frame() for each year is kept in the
+    store's ``quality``, so it is only worked out once per dataset version.
+    """
+    years = sorted(frames)
+    quality = {}
+    cleaned = []
+    for y in years:
+        frame, quality[y] = clean_frame(frames[y], states)
+        cleaned.append(frame.assign(year=y))
+    combined = pd.concat(cleaned, ignore_index=True, sort=False)
+    # A categorical year keeps describe() and the numeric sums from treating it as data.
+    # It stays the last column, so YearStore.year() can slice it off without a copy
+    combined['year'] = pd.Categorical(combined['year'], categories=years, ordered=True)
+    before = frame_nbytes(combined)
+    apply_schema(combined)
+    combined = combined.sort_values(['year', 'state'], kind='mergesort').reset_index(drop=True)
+    return YearStore(combined, memory={'before_bytes': before, 'after_bytes': frame_nbytes(combined)}, quality=quality)
+
+
+def load_all_years(dataset, commit=DATA_COMMIT):
+    """Load every year of a dataset into one YearStore, through the shared cache.
+
+    The year files are fetched concurrently; only the store built from them
+    stays in memory.
+    """
+    source = source_commit(dataset, commit)
+
+    def build():
+        with ThreadPoolExecutor(max_workers=len(YEARS)) as pool:
+            frames = dict(zip(YEARS, pool.map(lambda y: load_year(dataset, y, commit), YEARS)))
+        return build_year_store(frames, load_states())
+
+    return CACHE.get(derived_key('all', dataset, source), build, persist=persistent(source))
+
+
+def add_per_1000(frame, columns=('violent_crime', 'property_crime'), enrollment='student_enrollment'):
+    """Add '<column>_per_1000' rates (per 1000 enrolled students) for the given columns."""
+    enrollment = frame[enrollment] / 1000
+    for column in columns:
+        if column in frame:
+            frame[column + '_per_1000'] = frame[column] / enrollment
+    return frame
+
+
+def state_year_sums(frame, states):
+    """Sum every numeric column by (year, abv) for a frame that has a 'year' column."""
+    abv = state_abbreviations(frame['state'], states)
+    return frame.groupby([frame['year'].astype(str), abv], observed=True).sum(numeric_only=True)
+
+
+def build_state_cube(store, states):
+    """Precompute the (year x state) sums of every crime column and enrollment.
+
+    The per-1000 rates are derived from the summed columns, so every state
+    table and map in the dashboard is a lookup into this cube.
+    """
+    return add_per_1000(state_year_sums(store.frame, states))
+
+
+def state_sums(cube, year):
+    """The per-state sums (indexed by abbreviation) for one year of the cube."""
+    return cube.xs(year, level='year')
+
+
+def load_state_cube(commit=DATA_COMMIT):
+    """Load the (year x state) crime cube through the shared cache."""
+    return CACHE.get(derived_key('cube', CRIME, commit),
+                     lambda: build_state_cube(load_all_years(CRIME, commit), load_states()))
+
+
+def with_columns(df, **columns):
+    """df with extra columns appended, sharing df's column data rather than copying it."""
+    return pd.concat([df, pd.DataFrame(columns, index=df.index)], axis=1, copy=False)
+
+
+def crime_year(year, commit=DATA_COMMIT):
+    """One year of crime data, without the 'year' column."""
+    return load_all_years(CRIME, commit).year(year, drop_year=True)
+
+
+def lee_year(year, commit=DATA_COMMIT):
+    """One year of law enforcement data, with the 'employees_per_1000' column added."""
+    lee = load_all_years(LAW_ENFORCEMENT, commit).year(year, drop_year=True)
+    return with_columns(lee, employees_per_1000=lee['total_law_enforcement__employees'] / (lee['student_enrollment'] / 1000))
+
+
+def prepare_crime(df, states, small_school=2500):
+    """df plus the 'abv', 'small_school' and 'violent_crime_per_1000' columns used by the dashboard."""
+    enrollment = df['student_enrollment']
+    return with_columns(df,
+                        abv=state_abbreviations(df['state'], states),
+                        small_school=enrollment < small_school,
+                        violent_crime_per_1000=df['violent_crime'] / (enrollment / 1000))
+
+
+class StateIndex:
+    """Where each state's rows are in one year's frame, plus per-state summary stats.
+
+    The year frames from the YearStore are sorted by state, so every state is
+    one contiguous block of rows and selecting it is a positional slice (no
+    boolean scan and no copy). The count, violent crime total, and the mean,
+    median and position of the maximum violent_crime_per_1000 are worked out
+    for every state at once when the index is built.
+    """
+
+    def __init__(self, df):
+        states = df['state'].astype(str).to_numpy()
+        if len(states) and (states[1:] < states[:-1]).any():
+            raise ValueError('StateIndex needs a frame sorted by state')
+        starts = np.flatnonzero(np.r_[True, states[1:] != states[:-1]]) if len(states) else np.array([], dtype=int)
+        stops = np.r_[starts[1:], len(states)]
+        self.offsets = {states[start]: (int(start), int(stop)) for start, stop in zip(starts, stops)}
+
+        enrollment = df['student_enrollment'].to_numpy(dtype=float)
+        violent = df['violent_crime'].to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = pd.Series(violent / (enrollment / 1000))
+        by_state = rate.groupby(states, sort=False)
+        stats = pd.DataFrame({'count': by_state.size(),
+                              # Summed from the column itself, so integer counts stay integers
+                              'violent_crime': pd.Series(df['violent_crime'].to_numpy()).groupby(states, sort=False).sum(),
+                              'mean': by_state.mean(),
+                              'median': by_state.median()})
+        # Position (within the year frame) of each state's highest rate; states with no rates are left out
+        valid = rate.dropna()
+        stats['max_position'] = valid.groupby(states[valid.index.to_numpy()], sort=False).idxmax()
+        self.stats = stats
+
+    @property
+    def nbytes(self):
+        return frame_nbytes(self.stats)
+
+    def rows(self, df, state):
+        """The rows of df (the frame this index was built from, or one aligned with it) for a state."""
+        start, stop = self.offsets.get(state, (0, 0))
+        return df.iloc[start:stop]
+
+    def summary(self, state):
+        """count, violent_crime, mean, median and max_position for a state (NaN/0 if it has no rows)."""
+        if state not in self.stats.index:
+            return {'count': 0, 'violent_crime': 0, 'mean': np.nan, 'median': np.nan, 'max_position': np.nan}
+        # Column by column, as a row would turn the integer total into a float
+        return {column: self.stats.at[state, column] for column in self.stats.columns}
+
+
+def state_violent_total(df, state, index=None):
+    """Total violent crime reported in one state."""
+    if index is not None:
+        return index.summary(state)['violent_crime']
+    return df.loc[df['state'] == state, 'violent_crime'].sum()
+
+
+# Size bands used when streaming large tables: under 2500 is a small school, as in the dashboard
+SIZE_BANDS = (0, 2500, np.inf)
+
+
+def stream_state_aggregates(path, count_columns=('violent_crime', 'property_crime'), state='state',
+                            enrollment='student_enrollment', bands=SIZE_BANDS, chunksize=100000, thousands=',',
+                            **read_csv_args):
+    """Sum a CSV of any size by state and size band, reading it a chunk at a time.
+
+    This is the dashboard's state sums and small_school split for tables far
+    too big to load at once, such as the agency-level UCR offense tables
+    (where ``enrollment`` would be the population column). Only one chunk
+    and the running (state x band) totals are ever held in memory, so peak
+    memory depends on chunksize rather than the file size.
+
+    Returns (aggregates, report). The aggregates are indexed by (state,
+    size_band), with the row count, the summed enrollment and count columns,
+    and their per-1000 rates. As in clean_frame(), a zero, negative or
+    missing enrollment counts as missing; those rows, and rows with no state,
+    are left out, and the report counts them. Medians cannot be built up a
+    sum at a time like this.
+
+    Numbers may use ``thousands`` separators ('1,234'), as the UCR tables do,
+    and state names are normalized like the year files (see
+    normalize_state_names()), so 'New York3' and 'NEW YORK' are one state.
+    """
+    columns = [state, enrollment] + list(count_columns)
+    dtypes = {column: np.float64 for column in [enrollment] + list(count_columns)}
+    labels = ['%g-%g' % (low, high) for low, high in zip(bands[:-1], bands[1:])]
+    report = {'rows': 0, 'missing_state': 0, 'missing_or_zero_enrollment': 0, 'dropped': 0}
+    totals = None
+    for chunk in pd.read_csv(path, usecols=columns, dtype=dtypes, chunksize=chunksize, thousands=thousands,
+                             **read_csv_args):
+        names = normalize_state_names(chunk[state])
+        names = names.where(names != '')
+        size = chunk[enrollment].where(chunk[enrollment] > 0)
+        band = pd.cut(size, bins=list(bands), right=False, labels=labels)
+        report['rows'] += len(chunk)
+        report['missing_state'] += int(names.isna().sum())
+        report['missing_or_zero_enrollment'] += int(size.isna().sum())
+        report['dropped'] += int((names.isna() | band.isna()).sum())
+        sums = chunk[[enrollment] + list(count_columns)].assign(rows=1.0)
+        part = sums.groupby([names, band], observed=True).sum()
+        totals = part if totals is None else totals.add(part, fill_value=0)
+    if totals is None:
+        totals = pd.DataFrame(columns=[enrollment] + list(count_columns) + ['rows'])
+    totals.index = totals.index.set_names([state, 'size_band'])
+    totals['rows'] = totals['rows'].astype(np.int64)
+    return add_per_1000(totals.sort_index(), columns=count_columns, enrollment=enrollment), report
+
+
+def rollup_state_aggregates(aggregates, level='state', count_columns=('violent_crime', 'property_crime'),
+                            enrollment='student_enrollment'):
+    """Combine stream_state_aggregates() output over one index level ('state' or 'size_band')."""
+    sums = aggregates.drop(columns=[c + '_per_1000' for c in count_columns if c + '_per_1000' in aggregates])
+    return add_per_1000(sums.groupby(level=level).sum(), columns=count_columns, enrollment=enrollment)
+
+
+# Enrollment bands the quantile sketches are kept for. A small/large school
+# threshold can be any of these edges.
+SKETCH_BANDS = (0, 500, 1000, 1500, 2000, 2500, 3000, 4000, 5000, 7500, 10000, 15000, 20000, 30000, 50000, np.inf)
+SKETCH_ALPHA = 0.01
+ZERO_BUCKET = np.iinfo(np.int32).min
+
+
+def sketch_buckets(values, alpha=SKETCH_ALPHA):
+    """Logarithmic bucket number of each value; zero and negative values share ZERO_BUCKET."""
+    gamma = (1 + alpha) / (1 - alpha)
+    values = np.asarray(values, dtype=float)
+    buckets = np.full(len(values), ZERO_BUCKET, dtype=np.int32)
+    positive = values > 0
+    buckets[positive] = np.ceil(np.log(values[positive]) / np.log(gamma))
+    return buckets
+
+
+def bucket_values(buckets, alpha=SKETCH_ALPHA):
+    """The value each bucket stands for, within alpha (relative) of anything in the bucket."""
+    gamma = (1 + alpha) / (1 - alpha)
+    buckets = np.asarray(buckets)
+    values = 2 * np.power(gamma, buckets.astype(float)) / (gamma + 1)
+    return np.where(buckets == ZERO_BUCKET, 0.0, values)
+
+
+class QuantileSketches:
+    """Mergeable quantile sketches for every numeric column, per (year, state, enrollment band).
+
+    Each sketch is a count of values per logarithmic bucket (the DDSketch
+    scheme): bucket i holds values in (gamma^(i-1), gamma^i], with
+    gamma = (1 + alpha) / (1 - alpha). Any quantile read from a sketch is
+    within a relative error of alpha (1% by default) of the exact quantile
+    of the data it covers, plus 0.5 for the rounded integer columns (see
+    below), and zeros are exact. Medians are read at rank
+    floor((n - 1) / 2), so for an even number of values this is the lower of
+    the two middle values rather than pandas' average of the two.
+
+    For integer columns (the crime counts and enrollment) the estimate is
+    rounded to a whole number. That makes it exact for values under 50, but
+    the rounding can add up to 0.5 to the error (an enrollment of 483 may
+    come out as 478, just over 1% off).
+
+    The number of buckets grows with log(max / min) rather than the number
+    of rows, so memory stays bounded however many campuses there are.
+    Sketches merge by adding their counts, so medians over any set of
+    years, states and bands (and so any threshold on the band edges) come
+    from the precomputed counts without touching the rows again. The counts
+    are also split per column into flat arrays of (year, state, band,
+    bucket) codes, so a quantile only filters that column's few thousand
+    entries and adds them up per bucket with np.bincount.
+    """
+
+    LEVELS = ['year', 'state', 'size_band', 'column', 'bucket']
+
+    def __init__(self, counts, alpha=SKETCH_ALPHA, bands=SKETCH_BANDS, integer_columns=()):
+        self.counts = counts
+        self.alpha = alpha
+        self.bands = bands
+        self.integer_columns = set(integer_columns)
+        self._split_columns()
+
+    def __getstate__(self):
+        # The per-column arrays are rebuilt from the counts on load rather than pickled twice
+        state = self.__dict__.copy()
+        for name in ('_columns', '_years', '_states', '_bands'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._split_columns()
+
+    def _split_columns(self):
+        self._columns = {}
+        self._years = self._states = pd.Index([])
+        self._bands = np.array([])
+        index = self.counts.index
+        if not isinstance(index, pd.MultiIndex):
+            return
+        codes = dict(zip(index.names, index.codes))
+        levels = dict(zip(index.names, index.levels))
+        self._years, self._states, self._bands = levels['year'], levels['state'], levels['size_band'].to_numpy()
+        counts = self.counts.to_numpy().astype(np.int32)
+        for code in pd.unique(codes['column']):
+            rows = np.flatnonzero(codes['column'] == code)
+            # Bucket numbers as positions 0..n-1 in sorted order, for np.bincount
+            buckets, position = np.unique(levels['bucket'].to_numpy()[codes['bucket'][rows]], return_inverse=True)
+            self._columns[levels['column'][code]] = {
+                'year': codes['year'][rows], 'state': codes['state'][rows], 'band': codes['size_band'][rows],
+                'position': position.astype(np.int32), 'count': counts[rows], 'buckets': buckets}
+
+    @property
+    def nbytes(self):
+        return frame_nbytes(self.counts) + frame_nbytes(self._columns)
+
+    @classmethod
+    def from_frame(cls, df, columns=None, alpha=SKETCH_ALPHA, bands=SKETCH_BANDS, enrollment='student_enrollment'):
+        """Sketch every numeric column of a frame with 'year' and 'state' columns."""
+        if columns is None:
+            columns = [c for c in df.select_dtypes('number').columns if c != 'year']
+        band = pd.cut(df[enrollment], bins=list(bands), right=False, labels=list(bands[:-1])).astype(float)
+        keys = [df['year'].astype(str).to_numpy(), df['state'].astype(str).to_numpy(), band.to_numpy()]
+        parts = []
+        for column in columns:
+            values = df[column].to_numpy(dtype=float)
+            keep = ~np.isnan(values) & ~np.isnan(keys[2])
+            part = pd.DataFrame({'year': keys[0][keep], 'state': keys[1][keep], 'size_band': keys[2][keep],
+                                 'column': column, 'bucket': sketch_buckets(values[keep], alpha)})
+            parts.append(part.groupby(cls.LEVELS).size())
+        counts = pd.concat(parts) if parts else pd.Series(dtype=np.int64)
+        integer_columns = [c for c in columns if pd.api.types.is_integer_dtype(df[c])]
+        return cls(counts.rename('count'), alpha, bands, integer_columns)
+
+    def merge(self, other):
+        """A new set of sketches holding the data of both."""
+        counts = pd.concat([self.counts, other.counts]).groupby(level=self.LEVELS).sum()
+        return QuantileSketches(counts, self.alpha, self.bands, self.integer_columns & other.integer_columns)
+
+    def snap(self, threshold):
+        """The band edge nearest to an enrollment threshold."""
+        edges = [edge for edge in self.bands if np.isfinite(edge)]
+        return min(edges, key=lambda edge: abs(edge - threshold))
+
+    def _select(self, column, years=None, states=None, low=0, high=np.inf):
+        """The merged sketch for a column: the sorted bucket numbers and the count in each."""
+        split = self._columns.get(column)
+        if split is None:
+            return np.array([], dtype=np.int32), np.array([])
+        mask = ((self._bands >= low) & (self._bands < high))[split['band']]
+        if years is not None:
+            mask &= np.isin(split['year'], self._years.get_indexer([str(y) for y in years]))
+        if states is not None:
+            mask &= np.isin(split['state'], self._states.get_indexer(list(states)))
+        counts = np.bincount(split['position'][mask], weights=split['count'][mask], minlength=len(split['buckets']))
+        return split['buckets'], counts
+
+    def quantile(self, column, q=0.5, years=None, states=None, low=0, high=np.inf):
+        """Approximate q-quantile of a column, for enrollments in [low, high) (snapped to band edges)."""
+        buckets, counts = self._select(column, years, states, self.snap(low) if low else 0,
+                                       self.snap(high) if np.isfinite(high) else np.inf)
+        cumulative = counts.cumsum()
+        if not len(cumulative) or cumulative[-1] == 0:
+            return np.nan
+        # Empty buckets add nothing to the running total, so they are never the one found
+        position = np.searchsorted(cumulative, q * (cumulative[-1] - 1), side='right')
+        value = float(bucket_values([buckets[position]], self.alpha)[0])
+        return float(round(value)) if column in self.integer_columns else value
+
+    def medians(self, threshold=2500, years=None, states=None, columns=None):
+        """Median of every column for small schools under threshold (snapped to a band edge) vs the rest.
+
+        Indexed by small_school, with the violent crime rate per 1000
+        students worked out from the two medians.
+        """
+        edge = self.snap(threshold)
+        if columns is None:
+            columns = list(self._columns)
+        rows = {}
+        for small, low, high in ((False, edge, np.inf), (True, 0, edge)):
+            rows[small] = {column: self.quantile(column, 0.5, years, states, low, high) for column in columns}
+        medians = pd.DataFrame.from_dict(rows, orient='index')
+        medians.index.name = 'small_school'
+        medians['violent_crime_per_1000'] = medians['violent_crime'] / (medians['student_enrollment'] / 1000)
+        return medians
+
+
+def load_sketches(commit=DATA_COMMIT):
+    """Quantile sketches of every crime column for every year, through the shared cache."""
+    return CACHE.get(derived_key('sketches', CRIME, commit), lambda: QuantileSketches.from_frame(load_all_years(CRIME, commit).frame))
+
+
+# Campus names such as "Main" repeat across schools and states, so campuses
+# are matched on all three of these columns
+CAMPUS_KEY = ('state', 'university/college', 'campus')
+
+
+def campus_keys(frame, columns=CAMPUS_KEY):
+    """Normalized composite campus keys: upper case, single spaced, joined with '|'."""
+    keys = None
+    for column in columns:
+        part = frame[column].astype(str).str.upper().str.split().str.join(' ')
+        keys = part if keys is None else keys + '|' + part
+    return pd.Index(keys)
+
+
+class CampusIndex:
+    """A hash index of the law enforcement rows for one year, keyed on CAMPUS_KEY.
+
+    Only the first row for a duplicated key is kept, so joining against the
+    index never produces more rows than the crime frame has.
+    """
+
+    def __init__(self, lee):
+        self.key_columns = [column for column in CAMPUS_KEY if column in lee]
+        keys = campus_keys(lee, self.key_columns)
+        duplicated = keys.duplicated()
+        self.duplicates = int(duplicated.sum())
+        self.frame = lee.loc[~duplicated].reset_index(drop=True)
+        self.index = keys[~duplicated]
+
+    @property
+    def nbytes(self):
+        return frame_nbytes(self.frame) + int(self.index.memory_usage(deep=True))
+
+    def join(self, df):
+        """Inner join df onto the index, returning (joined frame, match report)."""
+        start = time.perf_counter()
+        key_columns = [column for column in self.key_columns if column in df]
+        positions = self.index.get_indexer(campus_keys(df, key_columns))
+        matched = positions >= 0
+        left = df.loc[matched].reset_index(drop=True)
+        right = self.frame.iloc[positions[matched]].drop(columns=key_columns).reset_index(drop=True)
+        # Other columns found in both frames get the same _x / _y suffixes pd.merge() would give them
+        overlap = [column for column in right.columns if column in left.columns]
+        left = left.rename(columns={column: column + '_x' for column in overlap})
+        right = right.rename(columns={column: column + '_y' for column in overlap})
+        joined = pd.concat([left, right], axis=1)
+        report = {'crime_rows': len(df),
+                  'lee_rows': len(self.frame) + self.duplicates,
+                  'matched': int(matched.sum()),
+                  'dropped': int((~matched).sum()),
+                  'lee_unmatched': len(self.frame) - len(set(positions[matched].tolist())),
+                  'lee_duplicates': self.duplicates,
+                  'seconds': time.perf_counter() - start}
+        return joined, report
+
+
+def merge_lee(df, lee):
+    """Join the crime frame to the law enforcement frame (or its CampusIndex) campus by campus.
+
+    Returns the joined frame and a report of how many rows matched, how many
+    were dropped and how long the join took.
+    """
+    index = lee if isinstance(lee, CampusIndex) else CampusIndex(lee)
+    return index.join(df)
+
+
+# The regression of law enforcement employees on violent crime is fitted from
+# these sufficient statistics, which can be summed across groups (states,
+# years) to get the fit for the combined group without refitting
+REGRESSION_X = 'violent_crime_per_1000'
+REGRESSION_Y = 'employees_per_1000'
+REGRESSION_STATS = ['n', 'sx', 'sy', 'sxy', 'sxx', 'syy']
+
+
+def regression_points(all_data):
+    """The finite (x, y) pairs used for the regression, as a two column frame."""
+    df = all_data[[REGRESSION_X, REGRESSION_Y]]
+    return df[np.isfinite(df.to_numpy(dtype=float)).all(axis=1)]
+
+
+def regression_stats(all_data, by=None):
+    """n, sum x, sum y, sum xy, sum x^2 and sum y^2, for each group of the 'by' columns.
+
+    With no 'by' columns a single row is returned for the whole frame.
+    """
+    points = regression_points(all_data)
+    x = points[REGRESSION_X].to_numpy(dtype=float)
+    y = points[REGRESSION_Y].to_numpy(dtype=float)
+    stats = pd.DataFrame({'n': np.ones(len(x)), 'sx': x, 'sy': y, 'sxy': x * y, 'sxx': x * x, 'syy': y * y},
+                         index=points.index)
+    if not by:
+        return stats.sum().to_frame().T
+    keys = [all_data.loc[points.index, column].astype(str) for column in by]
+    return stats.groupby(keys).sum()
+
+
+def fit_from_stats(stats):
+    """Fit every row of a regression_stats() frame at once.
+
+    Adds the slope and intercept of the least squares line, and the RMSE of
+    that line and of a baseline that always predicts the mean of y. Groups
+    with no points get NaN; groups where x never varies get a flat line.
+    """
+    fit = stats.copy()
+    n = fit['n'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = fit['sxx'] - fit['sx'] ** 2 / n
+        sxy = fit['sxy'] - fit['sx'] * fit['sy'] / n
+        syy = (fit['syy'] - fit['sy'] ** 2 / n).clip(lower=0)
+        slope = (sxy / sxx).where(sxx > 0, 0.0)
+        fit['slope'] = slope
+        fit['intercept'] = (fit['sy'] - slope * fit['sx']) / n
+        fit['lr_rmse'] = np.sqrt(((syy - slope * sxy).clip(lower=0)) / n)
+        fit['zr_rmse'] = np.sqrt(syy / n)
+    return fit
+
+
+def fit_regression(all_data):
+    """Fit a linear regression and a mean (ZeroR) baseline of employees_per_1000 on violent_crime_per_1000."""
+    points = regression_points(all_data)
+    X = points[[REGRESSION_X]].to_numpy(dtype=float)
+    y = points[REGRESSION_Y].to_numpy(dtype=float)
+    fit = fit_from_stats(regression_stats(points)).iloc[0]
+    predY = fit['intercept'] + fit['slope'] * X[:, 0]
+    zr_predY = np.full(len(y), fit['sy'] / fit['n'] if fit['n'] else np.nan)
+    return {'X': X, 'y': y, 'predY': predY, 'zr_predY': zr_predY,
+            'slope': fit['slope'], 'intercept': fit['intercept'],
+            'lr_rmse': fit['lr_rmse'], 'zr_rmse': fit['zr_rmse']}
+
+
+def state_detail(df, state, index=None):
+    """Rows for one state, with the mean, median and highest violent_crime_per_1000 entry.
+
+    With a StateIndex for df this is a lookup of the precomputed stats;
+    without one the state's rows are scanned for.
+    """
+    if index is not None:
+        summary = index.summary(state)
+        position = summary['max_position']
+        return {'frame': index.rows(df, state),
+                'mean': round(summary['mean'], 2),
+                'median': round(summary['median'], 2),
+                'max_row': df.iloc[int(position)] if pd.notna(position) else None}
+    state_df = df.loc[df['state'] == state]
+    rate = state_df['violent_crime_per_1000']
+    return {'frame': state_df,
+            'mean': round(rate.mean(), 2),
+            'median': round(rate.median(), 2),
+            'max_row': state_df.loc[rate.idxmax()] if rate.notna().any() else None}
+
+
+# Every crime column can be ranked by its rate per 1000 students
+RATE_COLUMNS = CRIME_COLUMNS[4:]
+
+
+class RankingIndex:
+    """Campuses sorted by their rate per 1000 students, for every crime column.
+
+    For each column the row positions of the combined (all years) frame are
+    kept sorted from the highest rate to the lowest, nationally and within
+    each state. A top-k query walks the sorted positions a block at a time,
+    applying the year, enrollment and state filters only to the block, so it
+    usually stops after looking at a few thousand rows however big the data
+    is. Rows with no finite rate (e.g. zero enrollment) are left out.
+
+    The indexed frame is not pickled with the index: it is the year store's
+    frame, which the cache already holds, so load_rankings() attaches it
+    again after reading the index back from disk.
+    """
+
+    BLOCK = 4096
+
+    def __init__(self, frame, columns=None, enrollment='student_enrollment'):
+        self.frame = frame
+        self.columns = [c for c in (columns or RATE_COLUMNS) if c in frame]
+        self.enrollment = frame[enrollment].to_numpy(dtype=float)
+        # Years and states are compared as integer codes
+        self.year_codes, years = pd.factorize(frame['year'].astype(str))
+        self.year_lookup = {year: code for code, year in enumerate(years)}
+        state_codes, states = pd.factorize(frame['state'].astype(str))
+        self.output_columns = [frame.columns.get_loc(c) for c in ['year', 'state', 'university/college', 'campus', enrollment]]
+        self.rates = {}
+        self.order = {}
+        self.state_order = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            per_1000 = self.enrollment / 1000
+            for column in self.columns:
+                rate = frame[column].to_numpy(dtype=float) / per_1000
+                finite = np.flatnonzero(np.isfinite(rate))
+                order = finite[np.argsort(-rate[finite], kind='stable')].astype(np.int32)
+                self.rates[column] = rate
+                self.order[column] = order
+                # A stable sort by state keeps each state's rows in rate order
+                by_state = order[np.argsort(state_codes[order], kind='stable')]
+                sorted_codes = state_codes[by_state]
+                starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(by_state) else []
+                stops = np.r_[starts[1:], len(by_state)] if len(by_state) else []
+                self.state_order[column] = {states[sorted_codes[a]]: by_state[a:b] for a, b in zip(starts, stops)}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['frame'] = None
+        return state
+
+    @property
+    def nbytes(self):
+        # Not the frame, which is counted with the year store
+        return (self.enrollment.nbytes + self.year_codes.nbytes + frame_nbytes(self.rates)
+                + frame_nbytes(self.order) + frame_nbytes(self.state_order))
+
+    def top_positions(self, column, k=10, year=None, state=None, min_enrollment=0, max_enrollment=np.inf):
+        """Row positions (in the indexed frame) of the k campuses with the highest column rate.
+
+        The results can be limited to one year, one state, and an enrollment
+        range [min_enrollment, max_enrollment), e.g. to a size band or to
+        leave out tiny schools whose rates jump around.
+        """
+        order = self.order[column] if state is None else self.state_order[column].get(state, np.array([], dtype=np.int32))
+        found = []
+        for start in range(0, len(order), self.BLOCK):
+            block = order[start:start + self.BLOCK]
+            enrollment = self.enrollment[block]
+            keep = (enrollment >= min_enrollment) & (enrollment < max_enrollment)
+            if year is not None:
+                keep &= self.year_codes[block] == self.year_lookup.get(year, -1)
+            found.extend(block[keep][:k - len(found)])
+            if len(found) >= k:
+                break
+        return found
+
+    def top(self, column, k=10, year=None, state=None, min_enrollment=0, max_enrollment=np.inf):
+        """The campuses from top_positions() as a frame, ranked from 1, with their rates."""
+        found = self.top_positions(column, k, year, state, min_enrollment, max_enrollment)
+        rows = self.frame.iloc[found, self.output_columns + [self.frame.columns.get_loc(column)]]
+        rows = rows.assign(**{column + '_per_1000': self.rates[column][found]})
+        rows.index = pd.RangeIndex(1, len(rows) + 1, name='rank')
+        return rows
+
+
+def load_rankings(commit=DATA_COMMIT):
+    """The RankingIndex for every year of crime data, through the shared cache."""
+    frame = load_all_years(CRIME, commit).frame
+    rankings = CACHE.get(derived_key('rankings', CRIME, commit), lambda: RankingIndex(frame))
+    # Read back from disk the index has no frame; it should always use the one in the cache
+    rankings.frame = frame
+    return rankings
+
+
+# Year-over-year trends are worked out for these columns' rates per 1000 students
+TREND_COLUMNS = ('violent_crime', 'property_crime')
+
+
+class TrendIndex:
+    """Rates per 1000 students laid out as a (key x year) table, for comparing years.
+
+    The keys are either state abbreviations (built from the state cube) or
+    campus keys (see campus_keys(), so a campus keeps its key from year to
+    year however its name is spaced or capitalised). Year-over-year deltas,
+    growth rates and rolling means are whole-table operations on the years
+    axis, so a query covers every state or campus and every year at once.
+    """
+
+    def __init__(self, wide, labels=None):
+        # wide has one row per key and (column, year) columns: the rates, plus student_enrollment
+        self.wide = wide
+        self.labels = labels
+        self.years = list(wide['student_enrollment'].columns)
+
+    @property
+    def nbytes(self):
+        return frame_nbytes(self.wide) + (frame_nbytes(self.labels) if self.labels is not None else 0)
+
+    @classmethod
+    def from_cube(cls, cube, columns=TREND_COLUMNS):
+        """A TrendIndex keyed by state abbreviation, from the (year x state) cube."""
+        rates = [column + '_per_1000' for column in columns]
+        wide = cube[rates + ['student_enrollment']].unstack('year')
+        wide.index = pd.Index(wide.index.astype(str), name='abv')
+        return cls(wide)
+
+    @classmethod
+    def from_frame(cls, frame, columns=TREND_COLUMNS, enrollment='student_enrollment'):
+        """A TrendIndex keyed by campus, from a frame with a 'year' column (e.g. a YearStore's)."""
+        columns = [column for column in columns if column in frame]
+        key_codes, keys = pd.factorize(campus_keys(frame))
+        year_codes, years = pd.factorize(frame['year'].astype(str), sort=True)
+        cells = key_codes * len(years) + year_codes
+        size = len(keys) * len(years)
+
+        def totals(values):
+            # Campuses listed twice in a year are added together. A cell is only
+            # missing when none of its rows reported a value, never 0
+            values = values.to_numpy(dtype=float)
+            known = ~np.isnan(values)
+            reported = np.bincount(cells[known], minlength=size)
+            return np.where(reported > 0, np.bincount(cells[known], weights=values[known], minlength=size), np.nan)
+
+        students = totals(frame[enrollment])
+        data = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for column in columns:
+                data[column + '_per_1000'] = np.where(students > 0, totals(frame[column]) / (students / 1000), np.nan)
+        data['student_enrollment'] = students
+        wide = pd.concat({name: pd.DataFrame(values.reshape(len(keys), len(years)), columns=list(years))
+                          for name, values in data.items()}, axis=1)
+        wide.index = pd.Index(keys, name='campus_key')
+        _, first = np.unique(key_codes, return_index=True)
+        labels = frame.iloc[first][list(CAMPUS_KEY)].reset_index(drop=True)
+        labels.index = wide.index
+        return cls(wide, labels)
+
+    def rates(self, column, keys=None):
+        """The (key x year) rates per 1000 students for a crime column."""
+        rates = self.wide[column + '_per_1000']
+        return rates if keys is None else rates.reindex(keys)
+
+    def trend(self, column, keys=None, window=3):
+        """Rate, delta and growth on the year before, and rolling mean, for every key and year.
+
+        Returns a frame indexed by (key, year). growth is the fractional
+        change (0.1 is 10% up), and is missing where the year before had a
+        rate of 0. The rolling mean is over up to ``window`` years ending at
+        each year.
+        """
+        rates = self.rates(column, keys)
+        values = rates.to_numpy(dtype=float)
+        before = np.c_[np.full((len(values), 1), np.nan), values[:, :-1]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            growth = np.where(before != 0, values / before - 1, np.nan)
+        # Rolling sums and counts of the known rates, from cumulative sums along the years
+        known = ~np.isnan(values)
+        sums = np.cumsum(np.where(known, values, 0), axis=1)
+        counts = np.cumsum(known, axis=1)
+        if values.shape[1] > window:
+            sums[:, window:] = sums[:, window:] - sums[:, :-window]
+            counts[:, window:] = counts[:, window:] - counts[:, :-window]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rolling = np.where(counts > 0, sums / counts, np.nan)
+        index = pd.MultiIndex.from_product([rates.index, rates.columns], names=[rates.index.name, 'year'])
+        return pd.DataFrame({column + '_per_1000': values.ravel(),
+                             'delta': (values - before).ravel(),
+                             'growth': growth.ravel(),
+                             'rolling_mean': rolling.ravel()}, index=index)
+
+    def change(self, column, start=None, end=None, k=None, min_enrollment=0):
+        """How each key's rate changed between two years (the first and last by default).
+
+        Keys missing either year, or with fewer than min_enrollment students
+        in either year, are left out. With k, only the k keys whose rate
+        moved the most (up or down) are returned, largest move first;
+        otherwise the keys are sorted by delta, biggest rise first.
+        """
+        start = start or self.years[0]
+        end = end or self.years[-1]
+        rates = self.rates(column)
+        students = self.wide['student_enrollment']
+        result = pd.DataFrame({start: rates[start], end: rates[end]})
+        result['delta'] = result[end] - result[start]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result['growth'] = (result[end] / result[start] - 1).where(result[start] != 0)
+        keep = result['delta'].notna() & (students[start] >= min_enrollment) & (students[end] >= min_enrollment)
+        result = result[keep]
+        if self.labels is not None:
+            result = self.labels.loc[result.index].join(result)
+        if k is None:
+            return result.sort_values('delta', ascending=False, kind='mergesort')
+        order = np.argsort(-result['delta'].abs().to_numpy(), kind='stable')[:k]
+        return result.iloc[order]
+
+
+def load_trends(level='state', commit=DATA_COMMIT):
+    """The state ('state') or campus ('campus') TrendIndex over every year, through the shared cache."""
+    if level == 'state':
+        return CACHE.get(derived_key('trends', 'state', commit), lambda: TrendIndex.from_cube(load_state_cube(commit)))
+    return CACHE.get(derived_key('trends', 'campus', commit), lambda: TrendIndex.from_frame(load_all_years(CRIME, commit).frame))
+
+
+def histogram_bins(values, bins=10):
+    """Counts and bin edges of the finite values, so a histogram can be drawn without the raw data."""
+    values = np.asarray(values, dtype=float)
+    return np.histogram(values[np.isfinite(values)], bins=bins)
+
+
+def density_bins(x, y, bins=100):
+    """2D counts (indexed [x bin, y bin]) and the x and y bin centres, for the finite (x, y) pairs."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    counts, x_edges, y_edges = np.histogram2d(x[finite], y[finite], bins=bins)
+    return counts, (x_edges[:-1] + x_edges[1:]) / 2, (y_edges[:-1] + y_edges[1:]) / 2
+
+
+# Above this many points the scatter is drawn as a density heatmap, since
+# sending every point to the browser gets slow
+SCATTER_POINT_LIMIT = 5000
+
+
+def figure_png(fig):
+    """A matplotlib Figure as PNG bytes.
+
+    Cached plots are shared by every session, and Figures aren't safe to use
+    from several threads at once, so plots are drawn on plain Figure objects
+    (outside pyplot's global state) and kept as images.
+    """
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+def choropleth_json(sums, column, title):
+    """A US map of one column of the per-state sums (indexed by abbreviation), as plotly JSON."""
+    import plotly.express as px
+    fig = px.choropleth(locations=sums.index, locationmode="USA-states", color=sums[column], scope="usa",
+                        color_continuous_scale='Reds')
+    fig.update_layout(title=title, title_x=0.5)
+    return fig.to_json()
+
+
+def enrollment_histogram(bins):
+    """The enrollment histogram, drawn from histogram_bins() counts and edges, as PNG bytes."""
+    from matplotlib.figure import Figure
+    counts, edges = bins
+    fig = Figure()
+    fig.subplots().hist(edges[:-1], edges, weights=counts)
+    return figure_png(fig)
+
+
+def scatter_json(all_data, x=REGRESSION_X, y=REGRESSION_Y, limit=SCATTER_POINT_LIMIT):
+    """A scatter of y against x as plotly JSON; a density heatmap (see density_bins()) above limit points."""
+    import plotly.express as px
+    import plotly.graph_objects as go
+    if len(all_data) <= limit:
+        fig = px.scatter(all_data, x=x, y=y, render_mode='webgl')
+    else:
+        counts, x_centres, y_centres = density_bins(all_data[x], all_data[y])
+        fig = go.Figure(go.Heatmap(z=counts.T, x=x_centres, y=y_centres, colorscale='Blues'))
+        fig.update_layout(xaxis_title=x, yaxis_title=y)
+    return fig.to_json()
+
+
+# Stage outputs are only kept in memory; they are cheap to rebuild from the cached data
+STAGE_CACHE = FrameCache(CACHE_MAX_BYTES // 4)
+
+# Every stage run is logged here as one JSON line. Set FBI_CRIME_STAGE_LOG to a
+# file name (or '-' for stderr) to collect them, and FBI_CRIME_TRACEMALLOC=1 to
+# include memory allocation figures from tracemalloc.
+STAGE_LOG = logging.getLogger('crimedata.stages')
+if os.environ.get('FBI_CRIME_STAGE_LOG') and not STAGE_LOG.handlers:
+    _log_target = os.environ['FBI_CRIME_STAGE_LOG']
+    STAGE_LOG.addHandler(logging.StreamHandler() if _log_target == '-' else logging.FileHandler(_log_target))
+    STAGE_LOG.setLevel(logging.INFO)
+if os.environ.get('FBI_CRIME_TRACEMALLOC') == '1' and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+def count_rows(value):
+    """Number of rows in a stage output, if it holds a frame; otherwise None."""
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(value)
+    if isinstance(value, tuple) and value:
+        return count_rows(value[0])
+    if isinstance(value, dict) and 'frame' in value:
+        return count_rows(value['frame'])
+    return None
+
+
+class Pipeline:
+    """Runs named dashboard stages, memoizing each one on its declared inputs.
+
+    A stage is identified by its name plus the widget values it depends on,
+    e.g. ('state_detail', year, stateInfo), so changing one widget only
+    rebuilds the stages that list it as an input. Which stages were rebuilt
+    or reused during this run are kept in ``recomputed`` and ``reused``.
+
+    Every stage is also timed: ``timings`` holds one record per stage with
+    its wall time, rows in and out, and (when tracemalloc is tracing) the
+    memory allocated and the peak while it ran. tracemalloc is process wide,
+    so with several sessions running at once the memory figures include
+    their allocations too.
+    """
+
+    def __init__(self, cache=STAGE_CACHE, commit=DATA_COMMIT):
+        self.cache = cache
+        self.commit = commit
+        self.recomputed = []
+        self.reused = []
+        self.timings = []
+
+    def run(self, name, build, *inputs, rows_in=None):
+        """Return build(*inputs), reusing the memoized value for these inputs if there is one."""
+        built = []
+
+        def load():
+            built.append(True)
+            return build(*inputs)
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # reset_peak() only exists from Python 3.9; before that the peak is left out
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        value = self.cache.get((name, self.commit) + inputs, load, persist=False)
+        seconds = time.perf_counter() - start
+        label = ' / '.join((name,) + inputs)
+        (self.recomputed if built else self.reused).append(label)
+
+        record = {'stage': label, 'recomputed': bool(built), 'seconds': round(seconds, 6),
+                  'rows_in': rows_in, 'rows_out': count_rows(value)}
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            record['alloc_bytes'] = current - before
+            if hasattr(tracemalloc, 'reset_peak'):
+                record['peak_bytes'] = peak - before
+        self.timings.append(record)
+        if STAGE_LOG.isEnabledFor(logging.INFO):
+            STAGE_LOG.info(json.dumps(dict(record, time=time.time(), pid=os.getpid())))
+        return value
+
+
+def quality_report():
+    """The clean_frame() report for each loaded dataset and year."""
+    report = {}
+    for dataset in (CRIME, LAW_ENFORCEMENT):
+        if derived_key('all', dataset, source_commit(dataset)) in CACHE:
+            report[dataset] = load_all_years(dataset).quality
+    return report
+
+
+def memory_report():
+    """Memory used by each loaded dataset before and after apply_schema(), in bytes."""
+    report = {}
+    for dataset in (CRIME, LAW_ENFORCEMENT):
+        key = derived_key('all', dataset, source_commit(dataset))
+        if key in CACHE:
+            report[dataset] = load_all_years(dataset).memory
+    return report
+
+
+def cache_stats():
+    """Snapshot of the shared cache counters and current size."""
+    stats = dict(CACHE.stats)
+    stats['entries'] = len(CACHE)
+    stats['bytes'] = CACHE.nbytes
+    stats['max_bytes'] = CACHE.max_bytes
+    return stats
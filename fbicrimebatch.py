@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Compute the dashboard numbers for every year and state, without Streamlit.
+
+This produces the same figures that fbicrimedata.py shows (violent crime
+totals and rates per 1000 students, small vs large school medians, estimated
+from the same sketches, the law enforcement merge, the regression RMSEs and
+the campus with the highest violent_crime_per_1000) for all (year, state)
+pairs, plus an 'ALL' row per year for the whole country, and writes them as
+a single report.
+
+    python fbicrimebatch.py --output report.json
+    python fbicrimebatch.py --years 2017 2018 --workers 4 --output report.parquet
+
+Parquet output needs pyarrow or fastparquet, which are not in
+requirements.txt; install one of them first.
+
+It can also sum a table too big to load at once (an agency-level UCR offense
+table, say) by state and size band, reading it in chunks:
+
+    python fbicrimebatch.py --stream offenses.csv --enrollment-column population --output states.json
+"""
+
+import argparse
+import importlib
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import crimedata
+
+ALL_STATES = 'ALL'
+
+
+def prepared_year(year):
+    """The prepared frames, state sums and per-state regression statistics for a year, shared by every state."""
+    pipeline = crimedata.Pipeline()
+    states = crimedata.load_states()
+    df_data = pipeline.run('prepared', lambda year: crimedata.prepare_crime(crimedata.crime_year(year), states), year)
+    lee_data = pipeline.run('lee', crimedata.lee_year, year)
+    sums = pipeline.run('state_sums', lambda year: crimedata.state_sums(crimedata.load_state_cube(), year), year)
+    state_index = pipeline.run('state_index', lambda year: crimedata.StateIndex(df_data), year)
+    regression = pipeline.run('regression_stats',
+                              lambda year: crimedata.regression_stats(crimedata.merge_lee(df_data, lee_data)[0], by=['state']),
+                              year)
+    return df_data, lee_data, sums, regression, state_index
+
+
+def year_state_metrics(year, state):
+    """Every dashboard number for one year and one state (or ALL_STATES), as a flat dict."""
+    df_data, lee_data, sums, regression, state_index = prepared_year(year)
+    detail = crimedata.state_detail(df_data, state, state_index) if state != ALL_STATES else None
+    if state != ALL_STATES:
+        df_data = detail['frame']
+        lee_data = lee_data.loc[lee_data['state'] == state] if 'state' in lee_data else lee_data
+
+    row = {'year': year, 'state': state, 'campuses': len(df_data)}
+    row['violent_crime'] = int(df_data['violent_crime'].sum())
+    row['student_enrollment'] = int(df_data['student_enrollment'].sum())
+    if state == ALL_STATES:
+        row['violent_crime_per_1000'] = row['violent_crime'] / (row['student_enrollment'] / 1000) if row['student_enrollment'] else math.nan
+    else:
+        abv = df_data['abv'].dropna()
+        row['violent_crime_per_1000'] = float(sums.loc[abv.iloc[0], 'violent_crime_per_1000']) if len(abv) else math.nan
+
+    # The same sketch estimates the dashboard shows, rather than exact medians
+    medians = crimedata.load_sketches().medians(2500, years=[year], states=None if state == ALL_STATES else [state])
+    for small, label in ((True, 'small'), (False, 'large')):
+        found = small in medians.index and not math.isnan(medians.loc[small, 'violent_crime'])
+        row[label + '_median_violent_crime'] = float(medians.loc[small, 'violent_crime']) if found else math.nan
+        row[label + '_median_violent_crime_per_1000'] = float(medians.loc[small, 'violent_crime_per_1000']) if found else math.nan
+
+    all_data, merge_report = crimedata.merge_lee(df_data, lee_data)
+    row['lee_rows'] = len(lee_data)
+    row['merged_rows'] = len(all_data)
+    row['merge_dropped'] = merge_report['dropped']
+    row['merge_seconds'] = merge_report['seconds']
+    # The national fit is the per-state statistics summed, rather than another pass over the rows
+    stats = regression.sum().to_frame().T if state == ALL_STATES else regression.reindex([state]).fillna(0)
+    fit = crimedata.fit_from_stats(stats).iloc[0]
+    row['lr_rmse'] = fit['lr_rmse']
+    row['zr_rmse'] = fit['zr_rmse']
+
+    top = detail['max_row'] if detail else None
+    if top is None and state == ALL_STATES and df_data['violent_crime_per_1000'].notna().any():
+        top = df_data.loc[df_data['violent_crime_per_1000'].idxmax()]
+    row['mean_violent_crime_per_1000'] = detail['mean'] if detail else round(df_data['violent_crime_per_1000'].mean(), 2)
+    row['median_violent_crime_per_1000'] = detail['median'] if detail else round(df_data['violent_crime_per_1000'].median(), 2)
+    row['top_university'] = top['university/college'] if top is not None else None
+    row['top_campus'] = top['campus'] if top is not None else None
+    row['top_violent_crime_per_1000'] = float(top['violent_crime_per_1000']) if top is not None else math.nan
+    return row
+
+
+def _run_pair(pair):
+    return year_state_metrics(*pair)
+
+
+def build_report(years=crimedata.YEARS, workers=None):
+    """Compute year_state_metrics() for every (year, state) pair in a process pool."""
+    states = sorted(set(crimedata.load_states()['State'].tolist()))
+    pairs = [(year, state) for year in years for state in [ALL_STATES] + states]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        rows = [_run_pair(pair) for pair in pairs]
+    else:
+        # Pairs are sent in year order, so each worker mostly sees one year and
+        # loads it from the shared on-disk cache only once
+        chunksize = max(1, len(pairs) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(_run_pair, pairs, chunksize=chunksize))
+    return pd.DataFrame(rows)
+
+
+def parquet_available():
+    """Whether pandas has an engine (pyarrow or fastparquet) to write Parquet files with."""
+    for module in ('pyarrow', 'fastparquet'):
+        try:
+            importlib.import_module(module)
+            return True
+        except ImportError:
+            pass
+    return False
+
+
+def write_report(report, output):
+    """Write the report as Parquet if the file name ends in .parquet, otherwise as JSON records."""
+    if output.endswith('.parquet'):
+        report.to_parquet(output, index=False)
+    else:
+        report.to_json(output, orient='records', indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute the FBI crime dashboard metrics for every year and state.')
+    parser.add_argument('--years', nargs='+', default=list(crimedata.YEARS), choices=crimedata.YEARS)
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--output', default='fbicrime_report.json', help='.json or .parquet file to write')
+    parser.add_argument('--stream', metavar='CSV', help='sum this CSV by state and size band, in chunks, instead')
+    parser.add_argument('--state-column', default='state', help='state name column for --stream')
+    parser.add_argument('--enrollment-column', default='student_enrollment', help='size column for --stream')
+    parser.add_argument('--count-columns', nargs='+', default=['violent_crime', 'property_crime'],
+                        help='columns --stream sums (and gives per-1000 rates for)')
+    parser.add_argument('--chunksize', type=int, default=100000, help='rows per chunk for --stream')
+    parser.add_argument('--thousands', default=',', help="thousands separator in --stream numbers ('' for none)")
+    args = parser.parse_args(argv)
+    # Check before spending minutes on the report rather than failing at the end
+    if args.output.endswith('.parquet') and not parquet_available():
+        parser.error('writing .parquet needs pyarrow or fastparquet (pip install pyarrow), or use a .json output')
+
+    if args.stream:
+        start = time.perf_counter()
+        aggregates, report = crimedata.stream_state_aggregates(
+            args.stream, count_columns=args.count_columns, state=args.state_column,
+            enrollment=args.enrollment_column, chunksize=args.chunksize, thousands=args.thousands or None)
+        write_report(aggregates.reset_index(), args.output)
+        print('Left out', report['dropped'], 'of', report['rows'], 'rows:', report['missing_state'],
+              'with no state,', report['missing_or_zero_enrollment'], 'with a missing or zero', args.enrollment_column)
+        print('Wrote', len(aggregates), 'rows to', args.output, 'in', round(time.perf_counter() - start, 2), 'seconds')
+        return 0
+
+    # Load everything once up front, so the workers start from the on-disk cache
+    for dataset in (crimedata.CRIME, crimedata.LAW_ENFORCEMENT):
+        crimedata.load_all_years(dataset)
+    crimedata.load_state_cube()
+    crimedata.load_sketches()
+
+    start = time.perf_counter()
+    report = build_report(args.years, args.workers)
+    write_report(report, args.output)
+    print('Wrote', len(report), 'rows to', args.output, 'in', round(time.perf_counter() - start, 2), 'seconds')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for the dashboard stages, on synthetic data of any size.
+
+The real year files only have around 450 campuses each. To see how the
+dashboard code behaves on bigger inputs, this generates crime and law
+enforcement frames with the same columns as the UCR files (see
+crimedata.CRIME_COLUMNS and crimedata.LEE_COLUMNS) and times the crimedata
+functions behind each dashboard stage (see stage_functions()), recording
+wall time and peak traced memory:
+
+    python fbicrimebench.py --sizes 1000 10000 100000
+    python fbicrimebench.py --sizes 10000000 --stages load store cube merge regression
+
+Everything runs offline. Results are appended to a JSON file, tagged with
+the current git commit, so runs from different commits can be compared:
+
+    python fbicrimebench.py --compare <older commit>
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import crimedata
+
+# A few states are enough to give the groupbys and maps something to do
+STATE_NAMES = ['ALABAMA', 'CALIFORNIA', 'FLORIDA', 'ILLINOIS', 'MASSACHUSETTS',
+               'NEW YORK', 'OHIO', 'PENNSYLVANIA', 'TEXAS', 'WASHINGTON']
+STATE_ABBREVIATIONS = ['AL', 'CA', 'FL', 'IL', 'MA', 'NY', 'OH', 'PA', 'TX', 'WA']
+
+RESULTS_FILE = os.path.join('.benchmarks', 'results.json')
+
+def make_states():
+    """A states lookup with the same columns as states.csv, with upper case names."""
+    return pd.DataFrame({'State': STATE_NAMES, 'Abbreviation': STATE_ABBREVIATIONS})
+
+
+def make_crime_frame(rows, seed=0):
+    """A synthetic crime frame with crimedata.CRIME_COLUMNS and roughly realistic counts."""
+    rng = np.random.default_rng(seed)
+    schools = max(1, rows // 3)
+    school = rng.integers(0, schools, rows)
+    # Enrollment is heavily skewed, like the real data: lots of small schools, a few huge ones
+    enrollment = np.maximum(rng.lognormal(8, 1.2, rows).astype(np.int64), 50)
+    scale = enrollment / 1000
+    violent = rng.poisson(scale[:, None] * [0.01, 0.05, 0.1])
+    prop = rng.poisson(scale[:, None] * [0.5, 2.0, 0.1, 0.02])
+    df = pd.DataFrame({
+        'state': np.array(STATE_NAMES)[rng.integers(0, len(STATE_NAMES), rows)],
+        'university/college': ['University ' + str(s) for s in school],
+        'campus': np.where(rng.random(rows) < 0.3, 'Main', ['Campus ' + str(i) for i in range(rows)]),
+        'student_enrollment': enrollment,
+        'violent_crime': violent.sum(axis=1) + rng.poisson(scale * 0.01),
+        'murder_and_nonnegligent_manslaughter': violent[:, 0],
+        'robbery': violent[:, 1],
+        'aggravated_assault': violent[:, 2],
+        'property_crime': prop.sum(axis=1),
+        'burglary': prop[:, 0],
+        'larceny_theft': prop[:, 1],
+        'motor_vehicle_theft': prop[:, 2],
+        'arson': prop[:, 3],
+    })
+    return df[crimedata.CRIME_COLUMNS]
+
+
+def make_lee_frame(crime, fraction=0.75, seed=0):
+    """A law enforcement frame for a random subset of the campuses in a crime frame."""
+    rng = np.random.default_rng(seed + 1)
+    lee = crime.loc[rng.random(len(crime)) < fraction, ['state', 'university/college', 'campus', 'student_enrollment']].copy()
+    officers = rng.poisson(np.maximum(lee['student_enrollment'].to_numpy() / 1000, 0.5))
+    civilians = rng.poisson(np.maximum(lee['student_enrollment'].to_numpy() / 2500, 0.2))
+    lee['total_law_enforcement__employees'] = officers + civilians
+    lee['total_officers'] = officers
+    lee['total_civilians'] = civilians
+    return lee[crimedata.LEE_COLUMNS].reset_index(drop=True)
+
+
+def write_data_dir(path, rows, years=crimedata.YEARS, seed=0):
+    """Write <year>_Crime.csv, <year>_LawEnforcement.csv and states.csv files into path."""
+    os.makedirs(path, exist_ok=True)
+    for i, year in enumerate(years):
+        crime = make_crime_frame(rows, seed + i)
+        crime.to_csv(os.path.join(path, year + '_' + crimedata.CRIME + '.csv'), index=False)
+        make_lee_frame(crime, seed=seed + i).to_csv(
+            os.path.join(path, year + '_' + crimedata.LAW_ENFORCEMENT + '.csv'), index=False)
+    states = make_states()
+    states['State'] = states['State'].str.title()
+    states.to_csv(os.path.join(path, 'states.csv'), index=False)
+    return path
+
+
+def measure(fn, repeat=3):
+    """Best wall time over repeat calls, and the peak memory traced during the first call."""
+    tracemalloc.start()
+    value = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = fn()
+        best = min(best, time.perf_counter() - start)
+    return value, best, peak
+
+
+def stage_functions(csv_path, lee):
+    """The dashboard stages in order, as (name, function) pairs.
+
+    Each function takes a dict of the outputs of the earlier stages and
+    returns a dict of its own outputs to add to it. They call the same
+    crimedata functions as fbicrimedata.py, on one year of data, but build
+    the shared structures (year store, cube, sketches, rankings, trends)
+    directly rather than through the cache, so their build time is measured.
+    """
+    states = make_states()
+    year = crimedata.YEARS[0]
+
+    def lee_index(ctx):
+        lee_store = crimedata.build_year_store({year: lee}, states)
+        lee_data = lee_store.year(year, drop_year=True)
+        lee_data = crimedata.with_columns(lee_data, employees_per_1000=(
+            lee_data['total_law_enforcement__employees'] / (lee_data['student_enrollment'] / 1000)))
+        return {'lee_index': crimedata.CampusIndex(lee_data)}
+
+    return [
+        ('load', lambda ctx: {'raw': pd.read_csv(csv_path)}),
+        ('store', lambda ctx: {'store': crimedata.build_year_store({year: ctx['raw']}, states)}),
+        ('year', lambda ctx: {'df': ctx['store'].year(year, drop_year=True)}),
+        ('state_index', lambda ctx: {'state_index': crimedata.StateIndex(ctx['df'])}),
+        ('prepared', lambda ctx: {'df': crimedata.prepare_crime(ctx['df'], states)}),
+        ('cube', lambda ctx: {'sums': crimedata.state_sums(crimedata.build_state_cube(ctx['store'], states), year)}),
+        ('sketches', lambda ctx: {'sketches': crimedata.QuantileSketches.from_frame(ctx['store'].frame)}),
+        ('size_medians', lambda ctx: {'medians': ctx['sketches'].medians(2500, years=[year])}),
+        ('lee_index', lee_index),
+        ('merge', lambda ctx: {'all_data': crimedata.merge_lee(ctx['df'], ctx['lee_index'])[0]}),
+        ('regression', lambda ctx: {'regression': crimedata.fit_regression(ctx['all_data'])}),
+        ('rankings', lambda ctx: {'rankings': crimedata.RankingIndex(ctx['store'].frame)}),
+        ('top_k', lambda ctx: {'top': ctx['rankings'].top('violent_crime', 10, year=year, min_enrollment=1000)}),
+        ('trends', lambda ctx: {'trends': crimedata.TrendIndex.from_frame(ctx['store'].frame)}),
+        ('choropleth', lambda ctx: {'choropleth': crimedata.choropleth_json(
+            ctx['sums'], 'violent_crime', 'Violent crime by state in %s' % year)}),
+        ('histogram', lambda ctx: {'histogram': crimedata.enrollment_histogram(
+            crimedata.histogram_bins(ctx['df']['student_enrollment']))}),
+        ('scatter', lambda ctx: {'scatter': crimedata.scatter_json(ctx['all_data'])}),
+    ]
+
+
+def run_benchmarks(sizes, stages=None, repeat=3, seed=0):
+    """Time every selected stage at every size; returns a list of result dicts."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in sizes:
+            crime = make_crime_frame(rows, seed)
+            lee = make_lee_frame(crime, seed=seed)
+            csv_path = os.path.join(tmp, 'crime_%d.csv' % rows)
+            crime.to_csv(csv_path, index=False)
+            del crime
+            # Later stages need the earlier stages' outputs, so stages that were
+            # not asked for are still run once, just not timed
+            ctx = {}
+            for name, fn in stage_functions(csv_path, lee):
+                if stages and name not in stages:
+                    ctx.update(fn(ctx))
+                    continue
+                output, seconds, peak = measure(lambda: fn(ctx), repeat)
+                ctx.update(output)
+                results.append({'stage': name, 'rows': rows, 'seconds': seconds, 'peak_bytes': peak})
+                print('%-20s %10d rows %10.4f s %12.1f MB' % (name, rows, seconds, peak / 1e6))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_results(path=RESULTS_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(results, path=RESULTS_FILE):
+    """Append this run's results, tagged with the commit and time, to the results file."""
+    runs = load_results(path)
+    runs.append({'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results})
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(runs, f, indent=2)
+
+
+def compare(commit, path=RESULTS_FILE):
+    """Print the latest run against the most recent earlier run from the given commit."""
+    runs = load_results(path)
+    if not runs:
+        print('No benchmark results in', path)
+        return
+    older = [run for run in runs[:-1] if run['commit'].startswith(commit)]
+    if not older:
+        print('No earlier results for commit', commit)
+        return
+    base = {(r['stage'], r['rows']): r for r in older[-1]['results']}
+    print('Comparing', runs[-1]['commit'], 'against', older[-1]['commit'])
+    for r in runs[-1]['results']:
+        b = base.get((r['stage'], r['rows']))
+        if b:
+            print('%-20s %10d rows  time x%.2f  memory x%.2f' % (
+                r['stage'], r['rows'], r['seconds'] / b['seconds'], r['peak_bytes'] / max(b['peak_bytes'], 1)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard stages on synthetic UCR-shaped data.')
+    parser.add_argument('--sizes', nargs='+', type=lambda v: int(float(v)), default=[1000, 10000, 100000],
+                        help='numbers of campuses to generate (e.g. 1e3 1e7)')
+    parser.add_argument('--stages', nargs='+', default=None,
+                        help='only record these stages (load store year state_index prepared cube sketches size_medians '
+                             'lee_index merge regression rankings top_k trends choropleth histogram scatter)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--results', default=RESULTS_FILE, help='JSON file the results are appended to')
+    parser.add_argument('--compare', metavar='COMMIT', help='after running, compare with results from COMMIT')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.stages, args.repeat)
+    save_results(results, args.results)
+    if args.compare:
+        compare(args.compare, args.results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,7 +20,7 @@ All data was obtained from: https://ucr.fbi.gov/crime-in-the-u.s/
 We're using the following libraries in Python:
 - pandas (for data manipulation): https://pandas.pydata.org/
 - matplotlib (for plotting): https://matplotlib.org/
-- scikit learn (for regression): https://scikit-learn.org/stable/
+- numpy (for regression): https://numpy.org/
 - plotly (for graphing US states): https://plot.ly/python/
 
 The whole document is a Jupyter notebook: https://jupyter.org/
@@ -51,9 +51,23 @@ We then show some basic details, and display the first 5 records in the data.
 # Matplotlib is one of the graphing options we'll use later
 
 import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import streamlit as st
 
+# crimedata holds the loaders, and a cache shared by every session on this server
+import crimedata
+
+# # The dashboard is split into stages. Each stage is remembered using the widget values it
+# # depends on (the year, and the chosen states), so changing one widget only re-runs the
+# # stages that actually use it
+
+pipeline = crimedata.Pipeline()
+
+# # The first time the app starts, download every year's files at once in the background,
+# # so switching years never has to wait for a download
+
+crimedata.start_prefetch()
+
 st.title('Interactive FBI Crime Data')
 st.header('Nick Webb: webbn@union.edu')
 st.write("In this dashboard, we're going to load and analyze crime data from the FBI for US colleges and universities. All data was obtained from: https://ucr.fbi.gov/crime-in-the-u.s/")
@@ -66,11 +80,12 @@ st.write("In this dashboard, we're going to load and analyze crime data from the
 
 st.subheader("Loading the data")
 
-year = st.radio("Pick a year:", ('2014','2015','2016','2017','2018'))
+year = st.radio("Pick a year:", crimedata.YEARS)
 
-filename = "https://raw.githubusercontent.com/nixwebb/Hackathon2020/e464544c903484a9f701f753f90a3604bfa24f82/Data/"+year+"_Crime.csv"
+# # All five years are loaded once into a single frame, so switching years is just a slice of it.
+# # The slice shares the frame's data; later stages add columns with crimedata.with_columns() rather than changing it
 
-df_data = pd.read_csv(filename)
+df_data = pipeline.run('crime', crimedata.crime_year, year)
 
 st.write("Showing the first 5 entries of the year "+year+" as a dataframe")
 
@@ -111,7 +126,7 @@ st.subheader(text)
 
 st.write("Now we have some data, let's take a look at some statistics. Showing some basic descriptive statistics for the year "+year+" including counts, medians and means.")
 
-st.write(df_data.describe())
+st.write(pipeline.run('describe', lambda year: df_data.describe(), year, rows_in=len(df_data)))
 
 
 st.write("Next, we'll compute the total number of violent crimes in the data, and the total in NY state for the year",year)
@@ -126,12 +141,12 @@ violent_total_year = df_data['violent_crime'].sum()
 st.write('Violent Crime Total ('+year+'):',violent_total_year)
 
 
-states = pd.read_csv('https://raw.githubusercontent.com/jasonong/List-of-US-States/master/states.csv')
-states['State'] = states['State'].str.upper()
+# # The states lookup ships with the app (crimedata reads it once, already sorted), so there's nothing to download here
+
+states = crimedata.load_states()
 
-listOfStates = list(set(states['State'].tolist()))
+listOfStates = states['State'].tolist()
 #listOfStates = [n for n in listOfStates if n.isalpha()]
-listOfStates.sort()
 
 text = 'Crime per state: '+year
 
@@ -143,7 +158,11 @@ st.write("We can do the same thing, but this time ONLY selecting the numbers fro
 state = st.selectbox('Choose a state', listOfStates)
 
 
-state_violent_total_year = df_data.loc[df_data['state'] == state, 'violent_crime'].sum()
+# # Rather than searching the whole dataframe every time a state is picked, we work out where each
+# # state's rows are (the data is sorted by state), and the totals and averages for every state, once per year
+
+state_index = pipeline.run('state_index', lambda year: crimedata.StateIndex(df_data), year, rows_in=len(df_data))
+state_violent_total_year = crimedata.state_violent_total(df_data, state, state_index)
 st.write(state,'Violent Crime Total ('+year+'):',state_violent_total_year)
 
 # """I want to add a new column (a new variable) that's going to be useful for us later when we want to graph the output. I'm going to add a column representing the state abbreviation for each state (so NEW YORK will have an additional entry, NY).
@@ -162,7 +181,9 @@ st.write(state,'Violent Crime Total ('+year+'):',state_violent_total_year)
 # Once complete, I'll again look at the head of my df_2014 dataframe to make sure it added the new column.
 # """
 
-df_data['abv'] = df_data['state'].map(states.set_index('State')['Abbreviation'])
+# # crimedata.prepare_crime() also adds the 'small_school' and 'violent_crime_per_1000' columns we use later on
+
+df_data = pipeline.run('prepared', lambda year: crimedata.prepare_crime(df_data, states), year, rows_in=len(df_data))
 # df_2014.head()
 
 # """We're going to start with overall summaries by state.
@@ -181,13 +202,15 @@ text = 'Summary of crimes by state for '+year
 
 st.subheader(text)
 
-crime_df_year = df_data.groupby('abv')
+#crime_df_year = df_data.groupby('abv')
 #st.write(crime_df_year.describe().head())
 
 # # Creating a new dataframe that is summing the values for each entry by state
+# # These sums are computed once for every year and state when the data is first loaded,
+# # so here we only need to look up the year we want
 
-sum_by_year = crime_df_year.sum()
-st.write(sum_by_year)
+sum_by_year = pipeline.run('state_sums', lambda year: crimedata.state_sums(crimedata.load_state_cube(), year), year)
+st.write(sum_by_year.drop(columns=['violent_crime_per_1000', 'property_crime_per_1000'], errors='ignore'))
 
 # """Let's plot these values on a map. We can use the graphing library plotly, which allows us to access a map of the United States. As our dataframe above, sum_by_year already has the state abbreviation as the index, we can pass that to the map, along with the corresponding values from the 'violent_crime' column."""
 
@@ -212,6 +235,7 @@ titletext = 'Violent Crime / Colleges and Universities / '+year
 
 #import streamlit as st
 import plotly.express as px
+import plotly.io as pio
 
 #df = px.data.election()
 #geojson = px.data.election_geojson()
@@ -225,8 +249,9 @@ import plotly.express as px
 #st.plotly_chart(fig)
 
 
-fig = px.choropleth(locations=sum_by_year.index, locationmode="USA-states", color=sum_by_year['violent_crime'], scope="usa",color_continuous_scale='Reds')
-fig.update_layout(title=titletext,title_x=0.5)
+# # Each map is built once per year and kept (as plotly's JSON) for every later visit, so it isn't rebuilt each time
+
+fig = pio.from_json(pipeline.run('choropleth', lambda year, column: crimedata.choropleth_json(sum_by_year, column, titletext), year, 'violent_crime'))
 st.plotly_chart(fig)
 
 st.write("""So clearly, California and Texas are dangerous states to go to school in.
@@ -241,15 +266,15 @@ text = 'Summary of crimes by state / per 1000 students / '+year
 
 st.subheader(text)
 
-sum_by_year['violent_crime_per_1000'] = (sum_by_year['violent_crime'] / (sum_by_year['student_enrollment'] / 1000) )
+# # The 'violent_crime_per_1000' column was already added to the precomputed sums:
+# sum_by_year['violent_crime_per_1000'] = (sum_by_year['violent_crime'] / (sum_by_year['student_enrollment'] / 1000) )
 #sum_by_year_2014.head()
 
 # # And now let's graph THOSE results - using our new 'violent_crime_per_1000' column
 
 titletext = 'Violent Crime per 1000 students / Colleges and Universities / '+year
 
-fig = px.choropleth(locations=sum_by_year.index, locationmode="USA-states", color=sum_by_year['violent_crime_per_1000'], scope="usa",color_continuous_scale='Reds')
-fig.update_layout(title=titletext,title_x=0.5)
+fig = pio.from_json(pipeline.run('choropleth', lambda year, column: crimedata.choropleth_json(sum_by_year, column, titletext), year, 'violent_crime_per_1000'))
 # fig.show()
 st.plotly_chart(fig)
 
@@ -269,35 +294,52 @@ st.subheader(text)
 # A histogram is a good way to see that distributution of values across a variable.
 # """
 
-fig, ax = plt.subplots()
-ax.hist(df_data['student_enrollment'])
+# # The bars are counted once with numpy, and the figure is drawn from those counts rather than every school
+
+enrollment_bins = pipeline.run('enrollment_bins', lambda year: crimedata.histogram_bins(df_data['student_enrollment']), year, rows_in=len(df_data))
+
+# # Every session shares the cached plots, and matplotlib figures aren't safe to use from several threads
+# # at once, so the plots are built outside pyplot and kept as PNG images (see crimedata.figure_png)
+
+png = pipeline.run('enrollment_histogram', lambda year: crimedata.enrollment_histogram(enrollment_bins), year)
 
 # # Let's generate a histogram
 #test = df_data.hist(column='student_enrollment')
-st.pyplot(fig)
+st.image(png)
 
 st.write("""We can see that a large number of schools seem to have under 5000 students. In education,
 we often think of small schools as those having less than 2500 students. We'll partition the data using this idea, and show summary median statistics for small schools (True) vs. large schools (False)""")
 
 # # Add the small_school column to my data, based on the school size of 2500
 
-df_data['small_school'] = df_data['student_enrollment'] < 2500
+# # (this column was added by crimedata.prepare_crime() above)
+# df_data['small_school'] = df_data['student_enrollment'] < 2500
 #df_2014.head()
 
 # """Now, just like above when we grouped by state, this time we'll group the original data frame (df_2014) by this small school column."""
 
-school_type_df = df_data.groupby('small_school')
+#school_type_df = df_data.groupby('small_school')
 # school_type_df.describe().head()
 
 # """Now we'll output some descriptive statistics. We could use MEAN, but we'll use MEDIAN instead. Why? There's a relatively small number of schools here, and MEANS scores can often be very skewed by one or two very high values. MEDIAN gives us the central tendency instead, and can be more informative. """
 
-school_type_sum = school_type_df.median()
+# # You can move the threshold for a 'small' school with the slider.
+# # Rather than sorting every column for every threshold, we keep a compact summary (a 'sketch') of each
+# # column for schools in a number of size bands, and read the medians from the sketches for the bands
+# # either side of the threshold. These medians are estimates, to within 1% (give or take half a crime or
+# # student for the whole-number columns). The batch report uses the same estimates
+
+threshold = st.select_slider('Small school threshold (students):',
+                             options=[int(edge) for edge in crimedata.SKETCH_BANDS[1:-1]], value=2500)
+
+sketches = crimedata.load_sketches()
+school_type_sum = pipeline.run('size_medians', lambda year, threshold: sketches.medians(int(threshold), years=[year]), year, str(threshold))
 #st.write(school_type_sum)
 
 # """We can see from the dataframe above that the median number of violent crimes for large schools is 3, and for small schools it's 0. Just to check, let's add back in the student enrollment numbers, below:"""
 
 # # Let's add that violent_crime_per_1000 column into our dataframe.
-school_type_sum['violent_crime_per_1000'] = (school_type_sum['violent_crime'] / (school_type_sum['student_enrollment'] / 1000) )
+# school_type_sum['violent_crime_per_1000'] = (school_type_sum['violent_crime'] / (school_type_sum['student_enrollment'] / 1000) )
 st.write(school_type_sum)
 
 st.write("""So here's what we've shown so far: New York is a pretty safe state for students, and small schools are very safe for students. THEREFORE, we have shown that small schools in NY are the best.""")
@@ -307,8 +349,8 @@ st.subheader('Law Enforcement at Colleges and Universities Data')
 st.write("There are other tables in the data, detailing the number of law enforcement employees at Universities and Colleges. We read in this data, and perform the same data formatting as the crime statistics data.")
 
 # # Load in the Law Enforcement Employee (LEE) data for 2014
-file = 'https://raw.githubusercontent.com/nixwebb/Hackathon2020/master/Data/'+year+'_LawEnforcement.csv'
-lee_data = pd.read_csv(file)
+# # crimedata.lee_year() also adds the 'employees_per_1000' column described below
+lee_data = pipeline.run('lee', crimedata.lee_year, year)
 
 
 # # Get some details about how much data there is
@@ -322,7 +364,7 @@ st.write('There are',r,'rows and',c,'columns in this data')
 st.write("Note that there aren't the same number of rows in this data as there are in the crime data, indicating a data sparsity issue. \
 We're going to add in a new column that represents the number of law enforcement employees per 1000 students.")
 
-lee_data['employees_per_1000'] =  (lee_data['total_law_enforcement__employees'] / (lee_data['student_enrollment'] / 1000) )
+# lee_data['employees_per_1000'] =  (lee_data['total_law_enforcement__employees'] / (lee_data['student_enrollment'] / 1000) )
 st.write(lee_data.head())
 
 st.write("Next let's merge our two data frames. Once contains information on the number of crimes occuring at University and College campuses, the other contains the numbers and types of law enforcement employees at those campuses.")
@@ -331,16 +373,24 @@ st.write("Next let's merge our two data frames. Once contains information on the
 # # and our lee_2014 dataframe of law enforcement employees
 # # At the end of the resulting new dataframs (allData_2014), you should now see the columns from the lee_2014 data
 
-df_data['violent_crime_per_1000'] = (df_data['violent_crime'] / (df_data['student_enrollment'] / 1000) )
-allData = pd.merge(df_data,lee_data, left_on='campus', right_on='campus')
+# # Campus names like 'Main' appear in many states, so rather than just matching on 'campus'
+# # we match on the state, the university/college and the campus together:
+# allData = pd.merge(df_data,lee_data, left_on='campus', right_on='campus')
+
+lee_index = pipeline.run('lee_index', lambda year: crimedata.CampusIndex(lee_data), year, rows_in=len(lee_data))
+allData, merge_report = pipeline.run('merged', lambda year: crimedata.merge_lee(df_data, lee_index), year, rows_in=len(df_data))
+st.write('Matched',merge_report['matched'],'of',merge_report['crime_rows'],'campuses (',merge_report['dropped'],'had no law enforcement data)')
 st.write(allData.head())
 
 # # AND let's get a description of the data. Never a bad idea.
-st.write(allData.describe())
+st.write(pipeline.run('merged_describe', lambda year: allData.describe(), year, rows_in=len(allData)))
 
 st.write("""A scatter plot helps to understand relationships between variables - columns in our data frame. Here's I'm going to plot the relationship between violent_crime_per_1000 students, and employees_per_1000 students""")
 
-fig = px.scatter(allData, x='violent_crime_per_1000', y='employees_per_1000')
+# # With a lot of schools, sending every point to the browser gets slow. Above crimedata.SCATTER_POINT_LIMIT
+# # points we count the points in a grid instead, and show how many fall in each square as a heatmap
+
+fig = pio.from_json(pipeline.run('scatter', lambda year: crimedata.scatter_json(allData), year, rows_in=len(allData)))
 st.plotly_chart(fig)
 # fig.show()
 
@@ -360,46 +410,23 @@ RMSE (Root Mean Squared Error), and plotting the lines of best fit. In this inst
 number of employees our model predicts, so a lower value is better")
 # """
 
-# # Import libraries to help
-# # These include the scikit-learn machine learning library
-# # and the math library
-
-from sklearn.linear_model import LinearRegression
-from sklearn.dummy import DummyClassifier
-from sklearn.metrics import mean_squared_error
-import math
-
-
-# # Create a copy of the columns from our dataframe that I want (effectively creating a smaller dataframe)
+# # The fitting is done by crimedata.fit_regression(), which works like this:
+# #
+# # Select the columns from our dataframe that I want (effectively creating a smaller dataframe)
 # # I also need to drop some problematic values - those that are undefined in the original data
+# #
+# # Rather than handing the points to a machine learning library, we add up a handful of totals:
+# # the number of points n, and the sums of x, y, x*y, x*x and y*y. The line of best fit, and the
+# # RMSE of both the line and the ZeroR baseline (which always predicts the mean of y), can be
+# # worked out directly from those totals. The totals for two states can simply be added together
+# # to get the fit for both, which is how the batch report gets national numbers for free.
+# #
+# # LOWER values of RMSE are better
 
-df = allData[['violent_crime_per_1000','employees_per_1000']].copy()
-df.dropna(inplace=True)
-
-
-# # I then extract the values from the dataframe, using a mechanism called slicing
-
-array = df.values
-X = array[:,0:1]
-y = array[:,1]
-
-# # I create my baseline dummy classifier, called zr (for zeroR)
-
-zR = DummyClassifier(strategy="most_frequent")
-zeroR = zR.fit(X,y)
-zr_predY = zeroR.predict(X)
-
-# # I then create a linear regression classifier
-
-lr = LinearRegression()
-reg = lr.fit(X,y)
-predY = reg.predict(X)
-
-
-# # I can computer the error of both. LOWER values of RMSE are better
-
-lr_rmse = math.sqrt(mean_squared_error(y,predY))
-zr_rmse = math.sqrt(mean_squared_error(y,zr_predY))
+regression = pipeline.run('regression', lambda year: crimedata.fit_regression(allData), year, rows_in=len(allData))
+X, y = regression['X'], regression['y']
+predY, zr_predY = regression['predY'], regression['zr_predY']
+lr_rmse, zr_rmse = regression['lr_rmse'], regression['zr_rmse']
 
 
 st.write('Regression RMSE:',round(lr_rmse,2))
@@ -410,15 +437,20 @@ st.write('ZeroR RMSE:',round(zr_rmse,2))
 # # Hopefully one of the lines fits the data better than the other
 
 
-fig, ax = plt.subplots()
-ax.plot(X, y,'b^')
-ax.plot(X, predY, 'r',label='Linear Regression')
-ax.plot(X, zr_predY, 'g',label='ZeroR Baseline')
-#ax.set_title('Relationship between law enforcement employes versus violent crime, per 1000 students')
-ax.set_xlabel('Violent Crimes, per 1000 students')
-ax.set_ylabel('Law Enforcement Employees, per 1000 students')
-fig.legend()
-st.pyplot(fig)
+def regression_plot(year):
+    fig = Figure()
+    ax = fig.subplots()
+    ax.plot(X, y,'b^')
+    ax.plot(X, predY, 'r',label='Linear Regression')
+    ax.plot(X, zr_predY, 'g',label='ZeroR Baseline')
+    #ax.set_title('Relationship between law enforcement employes versus violent crime, per 1000 students')
+    ax.set_xlabel('Violent Crimes, per 1000 students')
+    ax.set_ylabel('Law Enforcement Employees, per 1000 students')
+    fig.legend()
+    return crimedata.figure_png(fig)
+
+png = pipeline.run('regression_plot', regression_plot, year)
+st.image(png)
 #plt.show()
 
 st.write("""As the last thing in this tutorial, we're going to focus on individual state data. First, we select a state, and then show how much data that leaves us with.""")
@@ -430,7 +462,11 @@ st.write("""As the last thing in this tutorial, we're going to focus on individu
 #state = st.selectbox('Choose a state', ("NEW YORK", "CALIFORNIA", "TEXAS"))
 stateInfo = st.selectbox('Choose a state of interest', listOfStates)
 
-state_df = df_data.loc[df_data['state'] == stateInfo].copy()
+# # crimedata.state_detail() looks up the rows for the state in the state index from earlier,
+# # along with the mean, median and highest violent_crime_per_1000 values described below
+
+state_detail = crimedata.state_detail(df_data, stateInfo, state_index)
+state_df = state_detail['frame']
 st.write(state_df.head())
 
 # # See how much data that leaves us with
@@ -453,19 +489,19 @@ st.write("It's worth remembering that because violent crime is so rare, small in
 # # Add a new column to our dataframe, that calculates the number
 # # of violent crimes per 1000 student enrollments for just this NYS data
 
-state_df['violent_crime_per_1000'] =  (state_df['violent_crime'] / (state_df['student_enrollment'] / 1000) )
+# state_df['violent_crime_per_1000'] =  (state_df['violent_crime'] / (state_df['student_enrollment'] / 1000) )
 #st.write(state_df.head())
 
 # # Let's find the mean and the median values for crime in NYS
 # # And then show the college campus that had the highest value of crime
 # # per 1000 students in the state
 
-mean_vcp_2014 = round(state_df['violent_crime_per_1000'].mean(),2)
-median_vcp_2014 = round(state_df['violent_crime_per_1000'].median(),2)
+mean_vcp_2014 = state_detail['mean']
+median_vcp_2014 = state_detail['median']
 
 
 st.write('For',stateInfo,'mean average crime per 1000 is',mean_vcp_2014,'( median:',median_vcp_2014,')')
-st.write('The entry with highest violent crime per 1000 people is:\n\n',state_df.loc[state_df['violent_crime_per_1000'].idxmax()])
+st.write('The entry with highest violent crime per 1000 people is:\n\n',state_detail['max_row'])
 
 # # And finally let's plot the results
 
@@ -505,3 +541,57 @@ st.write('The entry with highest violent crime per 1000 people is:\n\n',state_df
 
 # - You could look at other states, instead of NY.
 # """
+
+st.subheader('Highest crime rates at any campus, 2014 - 2018')
+
+st.write("""Above we found the school with the highest violent crime per 1000 students in one state for one year. \
+Here we rank every campus in every year, for any type of crime. Very small schools can have huge rates from a \
+single crime, so you can leave out schools below a minimum enrollment.""")
+
+rankings = crimedata.load_rankings()
+rank_column = st.selectbox('Type of crime', crimedata.RATE_COLUMNS)
+min_enrollment = st.number_input('Only schools with at least this many students', min_value=0, value=1000, step=500)
+rank_scope = st.radio('Rank campuses in:', ('All states, all years', 'All states, '+year, stateInfo+', all years', stateInfo+', '+year))
+
+rank_year = year if rank_scope.endswith(year) else None
+rank_state = stateInfo if rank_scope.startswith(stateInfo) else None
+st.write(rankings.top(rank_column, 10, year=rank_year, state=rank_state, min_enrollment=min_enrollment))
+
+st.subheader('How crime rates changed, 2014 - 2018')
+
+st.write("""Instead of looking at one year at a time, we can compare years. For every state, and every campus, the \
+rates per 1000 students are kept side by side for all five years, so the change between any two years is one \
+subtraction. Growth is the change as a fraction of the first year's rate (0.1 means 10% higher).""")
+
+# # Campuses are matched across years on their state, school and campus names (see crimedata.campus_keys)
+
+trend_column = st.radio('Compare', crimedata.TREND_COLUMNS)
+trend_start, trend_end = st.select_slider('Between', options=crimedata.YEARS, value=(crimedata.YEARS[0], crimedata.YEARS[-1]))
+
+state_trends = crimedata.load_trends('state')
+st.write(state_trends.change(trend_column, trend_start, trend_end))
+st.line_chart(state_trends.rates(trend_column).T)
+
+stateInfo_abv = states.set_index('State')['Abbreviation'].get(stateInfo)
+st.write(stateInfo, 'year by year, with the rolling mean over 3 years:', state_trends.trend(trend_column, [stateInfo_abv]))
+
+st.write('Campuses whose rate moved the most (with at least', min_enrollment, 'students in both years):')
+st.write(crimedata.load_trends('campus').change(trend_column, trend_start, trend_end, k=10, min_enrollment=min_enrollment))
+
+if st.sidebar.checkbox('Show data cache statistics'):
+    st.sidebar.write(crimedata.cache_stats())
+    st.sidebar.write('Memory per dataset, before and after compacting:', crimedata.memory_report())
+
+# # The data is checked and cleaned once, when it is first loaded. This shows what was fixed
+
+if st.sidebar.checkbox('Show data quality report'):
+    st.sidebar.write(crimedata.quality_report())
+
+if st.sidebar.checkbox('Show recomputed stages'):
+    st.sidebar.write('Recomputed on this run:', pipeline.recomputed)
+    st.sidebar.write('Reused from earlier runs:', pipeline.reused)
+
+# # Wall time, rows in and out, and memory allocated (when FBI_CRIME_TRACEMALLOC=1) for each stage
+
+if st.sidebar.checkbox('Show stage timings'):
+    st.sidebar.write(pd.DataFrame(pipeline.timings).set_index('stage'))
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Load test the dashboard with many simulated sessions at once, without a browser.
+
+Streamlit runs fbicrimedata.py from the top, in a thread per browser
+session, every time a widget changes. This does the same: each simulated
+session is a thread that re-runs the script over and over, changing the
+year radio or one of the two state selectboxes before each run as a user
+clicking around would. The script's streamlit calls go to a headless
+stand-in that returns each session's widget values and does the work the
+real server does with the output (figures are serialized to JSON or PNG,
+tables to JSON), so the timings cover the whole rerun.
+
+    python fbicrimeload.py --sessions 1 8 32 --reruns 20
+    python fbicrimeload.py --sessions 32 --processes 4 --data ~/Hackathon2020/Data
+
+By default the data is a synthetic copy of the year files (see
+fbicrimebench.write_data_dir()), so nothing is downloaded. For each number
+of sessions it prints the p50 / p95 / p99 rerun latency, the reruns per
+second across all sessions and the peak memory of each server process,
+and appends the results, tagged with the git commit, to a JSON file.
+"""
+
+import argparse
+import io
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+import fbicrimebench
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fbicrimedata.py')
+RESULTS_FILE = os.path.join('.benchmarks', 'load.json')
+
+# The widgets a simulated user changes between reruns, by label
+YEAR_WIDGET = 'Pick a year:'
+STATE_WIDGETS = ('Choose a state', 'Choose a state of interest')
+
+
+class HeadlessStreamlit(types.ModuleType):
+    """Stands in for the streamlit module while the script is re-run by the load test.
+
+    Widgets return the current session's value for their label (or their
+    default); every other call is counted as an element. The widget values
+    are per thread, so many sessions can run the script at once.
+    """
+
+    def __init__(self):
+        super().__init__('streamlit')
+        self._local = threading.local()
+        self.sidebar = self
+
+    def start_session(self, widgets):
+        self._local.widgets = widgets
+        self._local.elements = 0
+
+    def _widget(self, label, default, options=None):
+        value = getattr(self._local, 'widgets', {}).get(label, default)
+        if options is not None and value not in list(options):
+            return default
+        return value
+
+    def radio(self, label, options, index=0, **kwargs):
+        return self._widget(label, list(options)[index], options)
+
+    def selectbox(self, label, options, index=0, **kwargs):
+        return self._widget(label, list(options)[index], options)
+
+    def select_slider(self, label, options=(), value=None, **kwargs):
+        return self._widget(label, value if value is not None else list(options)[0])
+
+    def number_input(self, label, min_value=None, max_value=None, value=0, **kwargs):
+        return self._widget(label, value)
+
+    def checkbox(self, label, value=False, **kwargs):
+        return self._widget(label, value)
+
+    def cache(self, func=None, **kwargs):
+        return func if func is not None else (lambda f: f)
+
+    def _element(self, *args, **kwargs):
+        self._local.elements += 1
+        for arg in args:
+            # Tables are sent to the browser as data, so pay for converting them
+            if hasattr(arg, 'to_json'):
+                arg.to_json()
+
+    def plotly_chart(self, fig, *args, **kwargs):
+        self._local.elements += 1
+        fig.to_json()
+
+    def pyplot(self, fig=None, *args, **kwargs):
+        self._local.elements += 1
+        if fig is not None:
+            fig.savefig(io.BytesIO(), format='png')
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self._element
+
+
+def peak_memory():
+    """Peak resident memory of this process, in bytes (None where it can't be read)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_sessions(sessions, reruns, seed=0, think=0.0, script=SCRIPT):
+    """Run the script for this many concurrent sessions in this process; returns the timings.
+
+    Every session first runs the script once with the default widget
+    values, as a new browser tab does; those runs are not timed, so the
+    figures describe a warmed-up server rather than the first data load.
+    """
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    st = HeadlessStreamlit()
+    sys.modules['streamlit'] = st
+    import crimedata
+    with open(script) as f:
+        code = compile(f.read(), script, 'exec')
+    options = {YEAR_WIDGET: list(crimedata.YEARS)}
+    for label in STATE_WIDGETS:
+        options[label] = crimedata.load_states()['State'].tolist()
+
+    warmup = []
+    latencies = []
+    errors = []
+    started = []
+    # The clock starts once every session has warmed up
+    barrier = threading.Barrier(sessions, action=lambda: started.append(time.time()))
+    lock = threading.Lock()
+
+    def rerun(widgets):
+        st.start_session(widgets)
+        start = time.perf_counter()
+        try:
+            exec(code, {'__name__': '__main__', '__file__': script})
+        except Exception as e:  # the real server shows the exception and carries on
+            with lock:
+                errors.append(repr(e))
+        return time.perf_counter() - start
+
+    def session(number):
+        rng = random.Random(seed * 1000003 + number)
+        widgets = {}
+        seconds = rerun(widgets)
+        barrier.wait()
+        timed = []
+        for _ in range(reruns):
+            label = rng.choice(sorted(options))
+            widgets[label] = rng.choice(options[label])
+            timed.append(rerun(widgets))
+            if think:
+                time.sleep(think)
+        with lock:
+            warmup.append(seconds)
+            latencies.extend(timed)
+
+    threads = [threading.Thread(target=session, args=(n,)) for n in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'pid': os.getpid(), 'sessions': sessions, 'latencies': latencies, 'warmup': warmup,
+            'started': started[0], 'finished': time.time(), 'errors': errors, 'peak_bytes': peak_memory()}
+
+
+def _run_worker(args):
+    return run_sessions(*args)
+
+
+def run_load_test(sessions, processes=1, reruns=10, seed=0, think=0.0):
+    """Spread the sessions over fresh server processes and summarize their timings."""
+    processes = max(1, min(processes, sessions))
+    shares = [sessions // processes + (i < sessions % processes) for i in range(processes)]
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        workers = list(pool.map(_run_worker, [(n, reruns, seed + i, think) for i, n in enumerate(shares)]))
+
+    latencies = np.array([s for w in workers for s in w['latencies']])
+    seconds = max(w['finished'] for w in workers) - min(w['started'] for w in workers)
+    errors = [e for w in workers for e in w['errors']]
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (np.nan,) * 3
+    return {'sessions': sessions, 'processes': processes, 'reruns': int(len(latencies)),
+            'p50_seconds': float(p50), 'p95_seconds': float(p95), 'p99_seconds': float(p99),
+            'mean_seconds': float(latencies.mean()) if len(latencies) else np.nan,
+            'warmup_seconds': float(max(s for w in workers for s in w['warmup'])),
+            'reruns_per_second': len(latencies) / seconds if seconds > 0 else np.nan,
+            'peak_bytes': [w['peak_bytes'] for w in workers],
+            'errors': len(errors), 'first_error': errors[0] if errors else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the dashboard with concurrent simulated sessions.')
+    parser.add_argument('--sessions', nargs='+', type=int, default=[1, 4, 16],
+                        help='numbers of concurrent sessions to try')
+    parser.add_argument('--processes', type=int, default=1, help='server processes to spread the sessions over')
+    parser.add_argument('--reruns', type=int, default=10, help='timed reruns per session')
+    parser.add_argument('--think', type=float, default=0.0, help='seconds each session waits between reruns')
+    parser.add_argument('--data', help='directory or URL with the year files (default: synthetic data)')
+    parser.add_argument('--rows', type=int, default=500, help='campuses per year in the synthetic data')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=RESULTS_FILE, help='JSON file the results are appended to')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The server processes read these when they import crimedata
+        os.environ['FBI_CRIME_DATA_URL'] = args.data or fbicrimebench.write_data_dir(
+            os.path.join(tmp, 'data'), args.rows, seed=args.seed)
+        results = []
+        for sessions in args.sessions:
+            # A fresh disk cache for each run, so every run starts the same way
+            os.environ['FBI_CRIME_CACHE_DIR'] = os.path.join(tmp, 'cache_%d' % sessions)
+            result = run_load_test(sessions, args.processes, args.reruns, args.seed, args.think)
+            results.append(result)
+            print('%4d sessions %2d processes  p50 %8.4f s  p95 %8.4f s  p99 %8.4f s  %7.2f reruns/s  peak %s MB%s' % (
+                sessions, result['processes'], result['p50_seconds'], result['p95_seconds'], result['p99_seconds'],
+                result['reruns_per_second'], ' '.join('%.0f' % (b / 1e6) if b else '?' for b in result['peak_bytes']),
+                '  %d errors, e.g. %s' % (result['errors'], result['first_error']) if result['errors'] else ''))
+    fbicrimebench.save_results(results, args.results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
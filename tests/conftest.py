@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fbicrimebench  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def crime():
+    """One year of synthetic crime data, as read from the CSV."""
+    return fbicrimebench.make_crime_frame(3000, seed=1)
+
+
+@pytest.fixture(scope='session')
+def lee(crime):
+    """Synthetic law enforcement rows for most of the campuses in crime."""
+    return fbicrimebench.make_lee_frame(crime, seed=1)
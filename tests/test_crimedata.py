@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import crimedata
+import fbicrimebench
+
+
+def test_campus_join_matches_merge_on_normalized_keys(crime, lee):
+    # Respell some law enforcement names and repeat some rows; the join should see through both
+    lee = lee.copy()
+    respelled = lee.index[::7]
+    lee.loc[respelled, 'university/college'] = '  ' + lee.loc[respelled, 'university/college'].str.lower()
+    lee.loc[respelled, 'campus'] = lee.loc[respelled, 'campus'].str.replace(' ', '   ')
+    lee = pd.concat([lee, lee.iloc[::11].assign(total_officers=-1)], ignore_index=True)
+
+    joined, report = crimedata.merge_lee(crime, lee)
+
+    key = list(crimedata.CAMPUS_KEY)
+    right = lee.assign(_key=crimedata.campus_keys(lee).to_numpy()).drop_duplicates('_key').drop(columns=key)
+    expected = crime.assign(_key=crimedata.campus_keys(crime).to_numpy()).merge(right, on='_key').drop(columns='_key')
+    pd.testing.assert_frame_equal(joined, expected)
+    assert (joined['total_officers'] >= 0).all()
+    assert report['matched'] == len(expected)
+    assert report['dropped'] == len(crime) - len(expected)
+    assert report['lee_duplicates'] == len(lee) - len(right)
+
+
+def regression_frame(crime, lee):
+    all_data, _ = crimedata.merge_lee(crime, lee)
+    all_data['violent_crime_per_1000'] = all_data['violent_crime'] / (all_data['student_enrollment_x'] / 1000)
+    all_data['employees_per_1000'] = (all_data['total_law_enforcement__employees']
+                                      / (all_data['student_enrollment_y'] / 1000))
+    # A missing and an infinite rate, which the fit has to leave out
+    all_data.loc[0, 'violent_crime_per_1000'] = np.nan
+    all_data.loc[1, 'employees_per_1000'] = np.inf
+    return all_data
+
+
+def direct_fit(x, y):
+    slope, intercept = np.polyfit(x, y, 1)
+    lr_rmse = np.sqrt(np.mean((y - (intercept + slope * x)) ** 2))
+    zr_rmse = np.sqrt(np.mean((y - y.mean()) ** 2))
+    return slope, intercept, lr_rmse, zr_rmse
+
+
+def test_regression_from_stats_matches_direct_fit(crime, lee):
+    all_data = regression_frame(crime, lee)
+    points = all_data.iloc[2:]
+    x = points['violent_crime_per_1000'].to_numpy()
+    y = points['employees_per_1000'].to_numpy()
+
+    fit = crimedata.fit_regression(all_data)
+    assert len(fit['y']) == len(points)
+    np.testing.assert_allclose([fit['slope'], fit['intercept'], fit['lr_rmse'], fit['zr_rmse']],
+                               direct_fit(x, y), rtol=1e-6)
+
+
+def test_grouped_regression_matches_a_fit_per_group(crime, lee):
+    all_data = regression_frame(crime, lee)
+    fits = crimedata.fit_from_stats(crimedata.regression_stats(all_data, by=['state']))
+    points = all_data.iloc[2:]
+    for state, group in points.groupby('state'):
+        expected = direct_fit(group['violent_crime_per_1000'].to_numpy(), group['employees_per_1000'].to_numpy())
+        np.testing.assert_allclose(fits.loc[state, ['slope', 'intercept', 'lr_rmse', 'zr_rmse']].to_numpy(dtype=float),
+                                   expected, rtol=1e-6)
+
+
+def test_state_index_matches_a_boolean_scan(crime):
+    crime = crime.copy()
+    crime.loc[::50, 'student_enrollment'] = 0
+    year = crimedata.YEARS[0]
+    df = crimedata.build_year_store({year: crime}, fbicrimebench.make_states()).year(year, drop_year=True)
+    df = df.assign(violent_crime_per_1000=df['violent_crime'] / (df['student_enrollment'] / 1000))
+    index = crimedata.StateIndex(df)
+
+    for state in list(df['state'].cat.categories) + ['NOWHERE']:
+        indexed = crimedata.state_detail(df, state, index)
+        scanned = crimedata.state_detail(df, state)
+        pd.testing.assert_frame_equal(indexed['frame'], scanned['frame'])
+        assert (indexed['mean'], indexed['median']) == pytest.approx((scanned['mean'], scanned['median']), nan_ok=True)
+        if scanned['max_row'] is None:
+            assert indexed['max_row'] is None
+        else:
+            pd.testing.assert_series_equal(indexed['max_row'], scanned['max_row'])
+        assert crimedata.state_violent_total(df, state, index) == crimedata.state_violent_total(df, state)
+
+
+def test_sketch_quantiles_are_within_the_error_bound():
+    frames = {year: fbicrimebench.make_crime_frame(2000, seed=i) for i, year in enumerate(crimedata.YEARS[:3])}
+    frame = crimedata.build_year_store(frames, fbicrimebench.make_states()).frame
+    sketches = crimedata.QuantileSketches.from_frame(frame)
+    enrollment = frame['student_enrollment'].to_numpy(dtype=float)
+
+    for column in ['student_enrollment', 'violent_crime', 'property_crime', 'burglary']:
+        for years, states in ((None, None), (['2015'], None), (['2014', '2016'], ['TEXAS', 'OHIO'])):
+            rows = np.ones(len(frame), dtype=bool)
+            if years is not None:
+                rows &= frame['year'].astype(str).isin(years).to_numpy()
+            if states is not None:
+                rows &= frame['state'].astype(str).isin(states).to_numpy()
+            for low, high in ((0, 2500), (2500, np.inf), (0, np.inf)):
+                values = np.sort(frame[column].to_numpy(dtype=float)[rows & (enrollment >= low) & (enrollment < high)])
+                for q in (0.1, 0.5, 0.9):
+                    # The sketch reads the value at rank floor(q * (n - 1)); integer columns are rounded
+                    exact = values[int(np.floor(q * (len(values) - 1)))]
+                    estimate = sketches.quantile(column, q, years, states, low, high)
+                    assert abs(estimate - exact) <= sketches.alpha * exact + 0.5, (column, years, states, low, q)
+
+
+def test_merged_sketches_match_sketching_everything_at_once():
+    frames = {year: fbicrimebench.make_crime_frame(1000, seed=i) for i, year in enumerate(crimedata.YEARS[:2])}
+    frame = crimedata.build_year_store(frames, fbicrimebench.make_states()).frame
+    whole = crimedata.QuantileSketches.from_frame(frame)
+    halves = [crimedata.QuantileSketches.from_frame(frame.iloc[part]) for part in (slice(0, 1500), slice(1500, None))]
+    merged = halves[0].merge(halves[1])
+    pd.testing.assert_frame_equal(merged.medians(2500), whole.medians(2500), check_like=True)